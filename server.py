@@ -1,75 +1,436 @@
-from server.playerHandler import PlayerHandler
+from server.playerHandler import PlayerHandler, Snapshot, TICK_RATE, MAX_SPEED, parse_coordinate, parse_radius
+from server.registryLog import RegistryLog
+from server.sharedPlayerHandler import SharedTable, SharedPlayerHandler, TableFull, DEFAULT_CAPACITY
+from server.pushServer import PushServer
+from server.protocol import CONTENT_TYPE, SEND_INTERVAL_HEADER, MapTable, MapTableFull, encode_players, decode_updates
+from server.rateLimiter import UpdateLimiter, UPDATE_RATE, UPDATE_BURST, LIMITED, DUPLICATE
+from server.metrics import Counter, Gauge, Histogram, Registry
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import asyncio
 import json
+import multiprocessing
+import signal
+import sys
+import threading
+import time
 PORT = 8989
+PUSH_PORT = 8990
+DATA_DIR = "server_data"
+ROUTES = ("/", "/register", "/players", "/maps", "/sync", "/metrics")
 
-PLAYER_HANDLER = PlayerHandler()
+PLAYER_HANDLER: PlayerHandler | SharedPlayerHandler = PlayerHandler()
 PLAYER_HANDLER.start()
-    
+MAP_TABLE = PLAYER_HANDLER.maps
+LIMITER = UpdateLimiter()
+
+# Metrics, served in the Prometheus text format on GET /metrics
+# (with --workers, each worker process serves its own)
+REQUESTS = Counter("http_requests_total", "HTTP requests handled", ("route", "method", "status"))
+REQUEST_LATENCY = Histogram("http_request_seconds", "HTTP request handling time", ("route", "method"))
+
+def _metrics() -> Registry:
+    registry = Registry()
+    registry.register(
+        REQUESTS, REQUEST_LATENCY,
+        Gauge("players", 'Players on each map ("" = registered, not on a map yet)',
+              lambda: {(m,): n for m, n in PLAYER_HANDLER.map_counts().items()}, ("map",)),
+        *PLAYER_HANDLER.metrics(), *LIMITER.metrics(),
+    )
+    return registry
+
+METRICS = _metrics()
+
+class Server(ThreadingHTTPServer):
+    # One thread per connection; the default listen backlog (5) drops connections under load
+    request_queue_size = 128
+    daemon_threads = True
+
+class WorkerServer(Server):
+    # Every worker listens on the same port, the kernel spreads the connections
+    allow_reuse_port = True
+
 class Handler(BaseHTTPRequestHandler):
+    # Keep-alive: clients reuse one connection for all their requests (every answer has a
+    # Content-Length); a connection idle for `timeout` seconds is closed
+    protocol_version = "HTTP/1.1"
+    timeout = 60
+    # Headers and body are written separately: without TCP_NODELAY the body waits for the
+    # client's delayed ACK (about 40 ms per request on a kept-alive connection)
+    disable_nagle_algorithm = True
+
     # def log_message(self, fmt, *args):
     #     return
 
     def do_GET(self):
-        if self.path == "/":
+        self._timed("GET", self._handle_get)
+
+    def do_POST(self):
+        self._timed("POST", self._handle_post)
+
+    def _timed(self, method: str, handle) -> None:
+        path = urlsplit(self.path).path
+        route = path if path in ROUTES else "other"
+        self._status = 0
+        start = time.perf_counter()
+        try:
+            handle()
+        finally:
+            REQUEST_LATENCY.observe(time.perf_counter() - start, route, method)
+            REQUESTS.inc(route, method, str(self._status))
+
+    def send_response(self, code: int, message: str | None = None) -> None:
+        self._status = code
+        super().send_response(code, message)
+
+    def end_headers(self) -> None:
+        if self.command == "POST":
+            self.send_header(SEND_INTERVAL_HEADER, f"{LIMITER.interval:g}")
+        super().end_headers()
+
+    def _handle_get(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == "/":
             self._json(200, {"status": "ok"})
             return
             
-        if self.path == "/register":
-            pid = PLAYER_HANDLER.register()
+        if url.path == "/register":
+            try:
+                pid = PLAYER_HANDLER.register()
+            except TableFull:
+                self._json(503, {"error": "server_full"})
+                return
             self._json(200, {"message": "registration successful", "id": pid})
             return
 
-        if self.path == "/players":
-            self._json(200, {"players": PLAYER_HANDLER.list_players()})
+        if url.path == "/players":
+            self._get_players(query)
+            return
+
+        if url.path == "/metrics":
+            self._send_bytes(200, METRICS.render().encode("utf-8"), "text/plain; version=0.0.4")
+            return
+
+        if url.path == "/maps" and "name" in query:
+            # Only resolves: a map gets its id from the first update of a player on it (see _update)
+            name = query["name"][0]
+            mid = MAP_TABLE.id_of(name)
+            if mid is None:
+                self._json(404, {"error": "unknown_map"})
+                return
+            self._json(200, {"name": name, "id": mid})
             return
 
         self._json(404, {"error": "not_found"})
 
-    def do_POST(self):
-        if self.path != "/players":
+    def _handle_post(self):
+        url = urlsplit(self.path)
+        if url.path not in ("/players", "/sync"):
             self._json(404, {"error": "not_found"})
             return
 
         length = int(self.headers.get("Content-Length", "0"))
+        body = self.rfile.read(length)
+        if self.headers.get("Content-Type") == CONTENT_TYPE:
+            if url.path == "/sync":
+                self._sync_binary(body, parse_qs(url.query))
+            else:
+                self._post_binary(body)
+            return
         try:
-            body = self.rfile.read(length)
             data = json.loads(body.decode("utf-8"))
         except Exception:
             self._json(400, {"error": "invalid_json"})
             return
 
+        if url.path == "/sync":
+            self._sync(data)
+            return
+
         missing = [k for k in ("id", "x", "y", "map") if k not in data]
         if missing:
             self._json(400, {"error": "bad_fields", "missing": missing})
             return
 
         try:
-            pid = int(data["id"])
-            x = float(data["x"])
-            y = float(data["y"])
-            map_name = str(data["map"])
+            pid, x, y, map_name = _parse_update(data)
         except (ValueError, TypeError):
             self._json(400, {"error": "bad_fields"})
             return
 
-        ok = PLAYER_HANDLER.update(pid, x, y, map_name)
-        if not ok:
-            self._json(404, {"error": "player_not_found"})
+        status = _update(pid, x, y, map_name)
+        if status != 200:
+            self._update_error(status)
             return
 
         self._json(200, {"success": True})
 
+    def _post_binary(self, body: bytes) -> None:
+        try:
+            updates = decode_updates(body, MAP_TABLE)
+        except (ValueError, IndexError):
+            self._json(400, {"error": "bad_fields"})
+            return
+
+        for u in updates:
+            status = _update(u["id"], u["x"], u["y"], u["map"])
+            if status != 200:
+                self._update_error(status)
+                return
+        self.send_response(204)
+        self.end_headers()
+
+    def _sync(self, data: object) -> None:
+        """
+        POST /sync {"id", "x", "y", "map"[, "since", "radius"]}
+            -> updates the caller and answers with its view, like GET /players?id=N&since=V
+        POST /sync {"updates": [{"id", "x", "y", "map"}, ...][, "map", "x", "y", "radius", "since"]}
+            -> applies every update ("results" tells which ids were found), for relays and bots;
+               the view of "map" is included when it is given
+        """
+        if not isinstance(data, dict):
+            self._json(400, {"error": "bad_fields"})
+            return
+        try:
+            since = int(data.get("since", 0))
+            radius = parse_radius(data["radius"]) if data.get("radius") is not None else None
+        except (ValueError, TypeError):
+            self._json(400, {"error": "bad_fields"})
+            return
+
+        if "updates" in data:
+            if not isinstance(data["updates"], list):
+                self._json(400, {"error": "bad_fields"})
+                return
+            results = []
+            for u in data["updates"]:
+                try:
+                    results.append(_update(*_parse_update(u)) == 200)
+                except (KeyError, ValueError, TypeError):
+                    results.append(False)
+            resp: dict = {"results": results}
+            if "map" in data:
+                try:
+                    x = parse_coordinate(data["x"]) if "x" in data else None
+                    y = parse_coordinate(data["y"]) if "y" in data else None
+                except (ValueError, TypeError):
+                    self._json(400, {"error": "bad_fields"})
+                    return
+                resp.update(PLAYER_HANDLER.changes_since(since, str(data["map"]), x, y, radius))
+            self._json(200, resp)
+            return
+
+        missing = [k for k in ("id", "x", "y", "map") if k not in data]
+        if missing:
+            self._json(400, {"error": "bad_fields", "missing": missing})
+            return
+        try:
+            pid, x, y, map_name = _parse_update(data)
+        except (ValueError, TypeError):
+            self._json(400, {"error": "bad_fields"})
+            return
+
+        status = _update(pid, x, y, map_name)
+        if status != 200:
+            self._update_error(status)
+            return
+        self._json(200, {"success": True, **PLAYER_HANDLER.changes_since(since, map_name, x, y, radius, exclude=pid)})
+
+    def _sync_binary(self, body: bytes, query: dict[str, list[str]]) -> None:
+        """
+        POST /sync?since=V[&radius=R] with a binary UPDATE: the first record is the caller,
+        any following ones are applied too. Answers with the caller's view as a binary PLAYERS message.
+        """
+        try:
+            updates = decode_updates(body, MAP_TABLE)
+            caller = updates[0]
+            since = int(query["since"][0]) if "since" in query else 0
+            radius = parse_radius(query["radius"][0]) if "radius" in query else None
+        except (ValueError, IndexError):
+            self._json(400, {"error": "bad_fields"})
+            return
+
+        for u in updates:
+            status = _update(u["id"], u["x"], u["y"], u["map"])
+            if status != 200 and u is caller:
+                self._update_error(status)
+                return
+        delta = PLAYER_HANDLER.changes_since(since, caller["map"], caller["x"], caller["y"], radius, exclude=caller["id"])
+        self._send_bytes(200, encode_players(delta, MAP_TABLE), CONTENT_TYPE)
+
+    def _get_players(self, query: dict[str, list[str]]) -> None:
+        """
+        GET /players                              -> every player
+        GET /players?id=N[&radius=R]              -> players on the same map as player N (within R pixels)
+        GET /players?map=M[&x=X&y=Y&radius=R]     -> players on map M (within R pixels of X, Y)
+        Any of the above with &since=V only returns what changed after version V,
+        along with the ids that were removed and the new version (see PlayerHandler.changes_since).
+        R is clamped to MAX_RADIUS (see playerHandler.parse_radius).
+        Clients sending "Accept: application/x-monster-go" get the binary PLAYERS message instead.
+        """
+        try:
+            pid = int(query["id"][0]) if "id" in query else None
+            x = parse_coordinate(query["x"][0]) if "x" in query else None
+            y = parse_coordinate(query["y"][0]) if "y" in query else None
+            radius = parse_radius(query["radius"][0]) if "radius" in query else None
+            since = int(query["since"][0]) if "since" in query else None
+        except ValueError:
+            self._json(400, {"error": "bad_query"})
+            return
+
+        map_name = query["map"][0] if "map" in query else None
+        if pid is not None:
+            where = PLAYER_HANDLER.locate(pid)
+            if where is None:
+                self._json(404, {"error": "player_not_found"})
+                return
+            map_name, x, y = where
+
+        binary = CONTENT_TYPE in self.headers.get("Accept", "")
+        if not since and pid is None and radius is None:
+            # Whole map (or whole world): serve the shared pre-serialized snapshot
+            snap = PLAYER_HANDLER.snapshot(map_name)
+            if binary:
+                self._send_bytes(200, snap.encode("binary", _encode_binary), CONTENT_TYPE)
+            elif since is not None:
+                self._send_bytes(200, snap.encode("json_delta", _encode_json_delta), "application/json")
+            else:
+                self._send_bytes(200, snap.encode("json", _encode_json), "application/json")
+        elif binary:
+            delta = PLAYER_HANDLER.changes_since(since or 0, map_name, x, y, radius, exclude=pid)
+            self._send_bytes(200, encode_players(delta, MAP_TABLE), CONTENT_TYPE)
+        elif since is not None:
+            self._json(200, PLAYER_HANDLER.changes_since(since, map_name, x, y, radius, exclude=pid))
+        elif pid is not None:
+            self._json(200, {"players": PLAYER_HANDLER.players_near(pid, radius) or {}})
+        elif map_name is not None:
+            self._json(200, {"players": PLAYER_HANDLER.query_players(map_name, x, y, radius)})
+        else:
+            self._json(200, {"players": PLAYER_HANDLER.list_players()})
+
+    def _update_error(self, status: int) -> None:
+        self._json(status, {"error": UPDATE_ERRORS[status]})
+
     # Utility for JSON responses
     def _json(self, code: int, obj: object) -> None:
-        data = json.dumps(obj).encode("utf-8")
+        self._send_bytes(code, json.dumps(obj).encode("utf-8"), "application/json")
+
+    def _send_bytes(self, code: int, data: bytes, content_type: str) -> None:
         self.send_response(code)
-        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Type", content_type)
         self.send_header("Content-Length", str(len(data)))
         self.end_headers()
         self.wfile.write(data)
 
+UPDATE_ERRORS = {400: "bad_fields", 404: "player_not_found", 429: "rate_limited", 503: "too_many_maps"}
+
+def _update(pid: int, x: float, y: float, map_name: str) -> int:
+    '''
+    Apply an update within the player's budget (see UpdateLimiter): 200, 404 (unknown player), 429,
+    or 400 / 503 for a map the binary format cannot name (see MapTable).
+    '''
+    result = LIMITER.check(pid, (x, y, map_name))
+    if result == LIMITED:
+        return 429
+    if not PLAYER_HANDLER.is_registered(pid):
+        LIMITER.forget(pid)
+        return 404
+    try:
+        # Interned now, so snapshots of the map can always be encoded. Only for registered
+        # players within their budget: ids are never freed.
+        MAP_TABLE.intern(map_name)
+    except MapTableFull:
+        return 503
+    except ValueError:
+        return 400
+    if result == DUPLICATE:
+        found = PLAYER_HANDLER.repeat(pid, x, y, map_name)
+    else:
+        found = PLAYER_HANDLER.update(pid, x, y, map_name)
+    if not found:
+        LIMITER.forget(pid)
+        return 404
+    return 200
+
+def _parse_update(data: dict) -> tuple[int, float, float, str]:
+    return int(data["id"]), parse_coordinate(data["x"]), parse_coordinate(data["y"]), str(data["map"])
+
+# Serializers for the cached snapshots
+def _encode_json(snap: Snapshot) -> bytes:
+    return json.dumps({"players": snap.players}).encode("utf-8")
+
+def _encode_json_delta(snap: Snapshot) -> bytes:
+    return json.dumps({"version": snap.version, "full": True, "players": snap.players, "removed": []}).encode("utf-8")
+
+def _encode_binary(snap: Snapshot) -> bytes:
+    return encode_players({"version": snap.version, "full": True, "players": snap.players, "removed": []}, MAP_TABLE)
+
+def _serve_worker(port: int) -> None:
+    WorkerServer(("0.0.0.0", port), Handler).serve_forever()
+
 if __name__ == "__main__":
-    print(f"[Server] Running on localhost with port {PORT}")
-    HTTPServer(("0.0.0.0", PORT), Handler).serve_forever()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--push", action="store_true", help=f"also serve the push channel on port {PUSH_PORT}")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="serve HTTP from this many processes sharing the player table (SO_REUSEPORT)")
+    parser.add_argument("--slots", type=int, default=DEFAULT_CAPACITY, help="player capacity of the shared table")
+    parser.add_argument("--tick-rate", type=float, default=TICK_RATE,
+                        help="simulation ticks per second, 0 applies every update as it arrives")
+    parser.add_argument("--max-speed", type=float, default=MAX_SPEED, help="pixels per second, 0 disables the check")
+    parser.add_argument("--update-rate", type=float, default=UPDATE_RATE,
+                        help="updates per second allowed for each player, 0 for no limit")
+    parser.add_argument("--update-burst", type=float, default=UPDATE_BURST, help="updates a player may send back to back")
+    parser.add_argument("--data-dir", default=DATA_DIR,
+                        help='where registered players are kept across restarts, "" to forget them')
+    args = parser.parse_args()
+    max_speed = args.max_speed if args.max_speed > 0 else None
+    LIMITER = UpdateLimiter(args.update_rate, args.update_burst)
+    # Exit normally on SIGTERM, so the workers are stopped and the registry is checkpointed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    print(f"[Server] Running on localhost with port {args.port}")
+    if args.workers > 0:
+        # The shared table and its locks must exist before forking; the parent expires
+        # players (and serves the push channel), the workers only serve HTTP
+        ctx = multiprocessing.get_context("fork")
+        PLAYER_HANDLER.stop()
+        PLAYER_HANDLER = SharedPlayerHandler(SharedTable(ctx, args.slots), tick_rate=args.tick_rate, max_speed=max_speed)
+        MAP_TABLE = PLAYER_HANDLER.maps
+        METRICS = _metrics()
+        workers = [ctx.Process(target=_serve_worker, args=(args.port,), name=f"HTTPWorker-{i}", daemon=True)
+                   for i in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        print(f"[Server] {args.workers} workers")
+        if args.data_dir:
+            print("[Server] The registry is not kept across restarts with --workers")
+        PLAYER_HANDLER.start()
+        if args.push:
+            print(f"[Server] Push channel on port {PUSH_PORT}")
+            asyncio.run(PushServer(PLAYER_HANDLER, MAP_TABLE, limiter=LIMITER).serve("0.0.0.0", PUSH_PORT))
+        for worker in workers:
+            worker.join()
+    else:
+        PLAYER_HANDLER.stop()
+        registry = RegistryLog(args.data_dir) if args.data_dir else None
+        PLAYER_HANDLER = PlayerHandler(tick_rate=args.tick_rate, max_speed=max_speed, registry=registry)
+        PLAYER_HANDLER.start()
+        MAP_TABLE = PLAYER_HANDLER.maps
+        METRICS = _metrics()
+        if registry is not None:
+            print(f"[Server] Restored {sum(PLAYER_HANDLER.map_counts().values())} players from {args.data_dir}")
+        http_server = Server(("0.0.0.0", args.port), Handler)
+        try:
+            if not args.push:
+                http_server.serve_forever()
+            else:
+                print(f"[Server] Push channel on port {PUSH_PORT}")
+                threading.Thread(target=http_server.serve_forever, name="HTTPServer", daemon=True).start()
+                asyncio.run(PushServer(PLAYER_HANDLER, MAP_TABLE, limiter=LIMITER).serve("0.0.0.0", PUSH_PORT))
+        finally:
+            PLAYER_HANDLER.stop()
@@ -0,0 +1,310 @@
+"""
+Bot-swarm load generator for server.py
+
+Every simulated client follows the OnlineManager cycle: GET /register once, then at
+the poll rate either one POST /sync (what the game does) or a POST /players followed
+by a GET /players?map=...&since=... (--protocol split). Bots walk randomly around a map.
+
+    python -m server.loadTest --spawn --clients 10,100,1000 --rate 50 --duration 10
+
+--spawn starts a server.py on --port for the run, so its CPU usage can be reported too
+(Linux only); otherwise point --host/--port at a running server and pass --server-pid.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from urllib.parse import urlencode
+
+from server.protocol import CONTENT_TYPE, SEND_INTERVAL_HEADER, MapTable, encode_update, decode_players
+
+MAPS = ("map.tmx", "gym.tmx")
+MAP_SIZE = 64 * 60
+STEP = 4.0 * 64 / 50
+REGISTER_ATTEMPTS = 5
+
+
+@dataclass
+class Stats:
+    latencies: dict[str, list[float]] = field(default_factory=dict)
+    errors: dict[str, int] = field(default_factory=dict)
+    requests: int = 0
+
+    def record(self, route: str, seconds: float | None) -> None:
+        self.requests += 1
+        if seconds is None:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        else:
+            self.latencies.setdefault(route, []).append(seconds)
+
+
+class HttpConnection:
+    '''
+    Minimal HTTP/1.1 client over asyncio streams. Reconnects whenever the server
+    closes the connection (the stdlib HTTPServer answers in HTTP/1.0).
+    '''
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+
+    async def request(self, method: str, path: str, body: bytes = b"", headers: dict[str, str] | None = None) -> tuple[int, dict[str, str], bytes]:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(body)}"]
+        lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("ascii") + body)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed")
+        version, status = status_line.split()[:2]
+        resp_headers: dict[str, str] = {}
+        while (line := await self._reader.readline()) not in (b"\r\n", b""):
+            key, _, value = line.decode("latin-1").partition(":")
+            resp_headers[key.strip().lower()] = value.strip()
+        data = await self._reader.readexactly(int(resp_headers.get("content-length", "0")))
+        if version != b"HTTP/1.1" or resp_headers.get("connection", "").lower() == "close":
+            self.close()
+        return int(status), resp_headers, data
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class Bot:
+    def __init__(self, host: str, port: int, protocol: str, binary: bool, timeout: float, stats: Stats):
+        self.conn = HttpConnection(host, port)
+        self.timeout = timeout
+        self.protocol = protocol
+        self.binary = binary
+        self.stats = stats
+        self.maps = MapTable()
+        self.pid = -1
+        self.map = random.choice(MAPS)
+        self.x = random.uniform(0, MAP_SIZE)
+        self.y = random.uniform(0, MAP_SIZE)
+        self.version = 0
+        # Like the game, bots slow down to the send interval the server asks for
+        self.send_interval = 0.0
+
+    async def _timed(self, route: str, method: str, path: str, body: bytes = b"", headers: dict[str, str] | None = None):
+        start = time.perf_counter()
+        try:
+            status, resp_headers, data = await asyncio.wait_for(
+                self.conn.request(method, path, body, headers), self.timeout
+            )
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            self.conn.close()
+            self.stats.record(route, None)
+            return None
+        hint = resp_headers.get(SEND_INTERVAL_HEADER.lower())
+        if hint is not None:
+            self.send_interval = float(hint)
+        if status >= 400:
+            self.stats.record(route, None)
+            return None
+        self.stats.record(route, time.perf_counter() - start)
+        return resp_headers, data
+
+    def _read_players(self, resp_headers: dict[str, str], data: bytes) -> None:
+        if resp_headers.get("content-type") == CONTENT_TYPE:
+            self.version = decode_players(data, self.maps)["version"]
+        elif data:
+            self.version = json.loads(data).get("version", self.version)
+
+    async def register(self) -> bool:
+        resp = await self._timed("register", "GET", "/register")
+        if resp is None:
+            return False
+        self.pid = json.loads(resp[1])["id"]
+        if self.binary:
+            # Like the game: a JSON update puts us on our map, which gives the map its id (see server._update)
+            body = json.dumps({"id": self.pid, "x": self.x, "y": self.y, "map": self.map}).encode("utf-8")
+            if await self._timed("update", "POST", "/players", body, {"Content-Type": "application/json"}) is None:
+                return False
+            resp = await self._timed("maps", "GET", "/maps?" + urlencode({"name": self.map}))
+            if resp is None:
+                return False
+            self.maps.learn(json.loads(resp[1])["id"], self.map)
+        return True
+
+    def _walk(self) -> None:
+        self.x = min(max(self.x + random.choice((-STEP, 0.0, STEP)), 0.0), MAP_SIZE)
+        self.y = min(max(self.y + random.choice((-STEP, 0.0, STEP)), 0.0), MAP_SIZE)
+
+    async def step(self) -> None:
+        self._walk()
+        state = {"id": self.pid, "x": self.x, "y": self.y, "map": self.map}
+        if self.binary:
+            body = encode_update(self.pid, self.x, self.y, self.maps.id_of(self.map))
+            headers = {"Content-Type": CONTENT_TYPE, "Accept": CONTENT_TYPE}
+        else:
+            body = json.dumps({**state, "since": self.version}).encode("utf-8")
+            headers = {"Content-Type": "application/json"}
+
+        if self.protocol == "sync":
+            resp = await self._timed("sync", "POST", f"/sync?since={self.version}", body, headers)
+        else:
+            if await self._timed("update", "POST", "/players", body, headers) is None:
+                return
+            query = urlencode({"map": self.map, "since": self.version})
+            resp = await self._timed("fetch", "GET", f"/players?{query}", headers=headers if self.binary else None)
+        if resp is not None:
+            self._read_players(*resp)
+
+    async def run(self, interval: float, until: float) -> None:
+        # Spread the bots over the poll interval instead of firing them all at once
+        await asyncio.sleep(random.uniform(0, interval))
+        next_tick = time.perf_counter()
+        while next_tick < until:
+            await self.step()
+            # Like the game, a bot that fell behind does not try to catch up
+            next_tick = max(next_tick + max(interval, self.send_interval), time.perf_counter())
+            await asyncio.sleep(next_tick - time.perf_counter())
+        self.conn.close()
+
+
+def _stat(pid: int | str) -> list[str]:
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().rsplit(")", 1)[1].split()
+
+def _cpu_seconds(pid: int) -> float | None:
+    # The server and its direct children (server.py --workers)
+    try:
+        fields = _stat(pid)
+        ticks = int(fields[11]) + int(fields[12])
+    except (OSError, IndexError, ValueError):
+        return None
+    for child in os.listdir("/proc"):
+        if not child.isdigit():
+            continue
+        try:
+            fields = _stat(child)
+            if int(fields[1]) == pid:
+                ticks += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            continue
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_scenario(args: argparse.Namespace, n_clients: int, server_pid: int | None) -> dict:
+    stats = Stats()
+    bots = [Bot(args.host, args.port, args.protocol, args.binary, args.timeout, stats) for _ in range(n_clients)]
+    sem = asyncio.Semaphore(200)
+
+    async def _register(bot: Bot) -> bool:
+        # A swamped accept queue drops connections: retry so every run starts with all its clients
+        async with sem:
+            for _ in range(REGISTER_ATTEMPTS):
+                ok = await bot.register()
+                bot.conn.close()
+                if ok:
+                    return True
+                await asyncio.sleep(random.uniform(0.1, 0.5))
+            return False
+
+    registered = [b for b, ok in zip(bots, await asyncio.gather(*map(_register, bots))) if ok]
+    stats = Stats()
+    for bot in registered:
+        bot.stats = stats
+
+    cpu_before = _cpu_seconds(server_pid) if server_pid else None
+    start = time.perf_counter()
+    await asyncio.gather(*(b.run(1.0 / args.rate, start + args.duration) for b in registered))
+    elapsed = time.perf_counter() - start
+    cpu_after = _cpu_seconds(server_pid) if server_pid else None
+
+    errors = sum(stats.errors.values())
+    result = {
+        "clients": n_clients,
+        "registered": len(registered),
+        "rate": args.rate,
+        "protocol": args.protocol,
+        "binary": args.binary,
+        "seconds": round(elapsed, 2),
+        "requests": stats.requests,
+        "throughput": round((stats.requests - errors) / elapsed, 1),
+        "error_rate": round(errors / stats.requests, 4) if stats.requests else 0.0,
+        "server_cpu": round((cpu_after - cpu_before) / elapsed, 3) if cpu_before is not None and cpu_after is not None else None,
+        "routes": {},
+    }
+    for route, values in stats.latencies.items():
+        result["routes"][route] = {
+            "count": len(values),
+            "errors": stats.errors.get(route, 0),
+            "p50_ms": round(_percentile(values, 0.50) * 1000, 2),
+            "p95_ms": round(_percentile(values, 0.95) * 1000, 2),
+            "p99_ms": round(_percentile(values, 0.99) * 1000, 2),
+        }
+    for route, count in stats.errors.items():
+        result["routes"].setdefault(route, {"count": 0, "errors": count})
+    return result
+
+def print_result(r: dict) -> None:
+    cpu = f"{r['server_cpu'] * 100:.0f}%" if r["server_cpu"] is not None else "n/a"
+    print(f"[LoadTest] {r['clients']} clients ({r['registered']} registered) @ {r['rate']} Hz, "
+          f"{r['protocol']}{' binary' if r['binary'] else ''}: {r['throughput']} req/s, "
+          f"errors {r['error_rate'] * 100:.2f}%, server CPU {cpu}")
+    for route, s in sorted(r["routes"].items()):
+        if s["count"]:
+            print(f"    {route:<8} n={s['count']:<8} p50={s['p50_ms']}ms p95={s['p95_ms']}ms "
+                  f"p99={s['p99_ms']}ms errors={s['errors']}")
+        else:
+            print(f"    {route:<8} errors={s['errors']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Bot-swarm load generator for server.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8989)
+    parser.add_argument("--clients", default="10,100,1000", help="comma separated client counts, one run each")
+    parser.add_argument("--rate", type=float, default=50.0, help="update cycles per second per client")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds before a request counts as failed")
+    parser.add_argument("--protocol", choices=("sync", "split"), default="sync")
+    parser.add_argument("--binary", action="store_true", help="use the binary wire format")
+    parser.add_argument("--spawn", action="store_true", help="start a server.py for the runs")
+    parser.add_argument("--workers", type=int, default=0, help="with --spawn, server.py --workers")
+    parser.add_argument("--server-pid", type=int, default=None, help="pid of the server, to report its CPU usage")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    server = None
+    server_pid = args.server_pid
+    if args.spawn:
+        command = [sys.executable, "server.py", "--port", str(args.port), "--workers", str(args.workers), "--data-dir", ""]
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_pid = server.pid
+        time.sleep(1.0)
+    try:
+        results = []
+        for n in (int(c) for c in args.clients.split(",")):
+            result = asyncio.run(run_scenario(args, n, server_pid))
+            print_result(result)
+            results.append(result)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+if __name__ == "__main__":
+    main()
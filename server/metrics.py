@@ -0,0 +1,190 @@
+import bisect
+import threading
+import time
+from typing import Callable, Iterable
+
+"""
+Minimal Prometheus text format metrics, see GET /metrics
+
+    requests = Counter("requests_total", "Requests handled", ("route",))
+    requests.inc("/players")
+    REGISTRY.register(requests)
+"""
+
+PREFIX = "monster_go_"
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+LabelValues = tuple[str, ...]
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    name: str
+    help: str
+    labels: tuple[str, ...]
+    _values: dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, total in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, values)} {_format_value(total)}")
+        return lines
+
+
+class Gauge:
+    '''
+    Gauge read when the metrics are rendered: `collect` returns {label values: value}.
+    '''
+    def __init__(self, name: str, help: str, collect: Callable[[], dict[LabelValues, float]], labels: tuple[str, ...] = ()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for values, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    name: str
+    help: str
+    labels: tuple[str, ...]
+    buckets: tuple[float, ...]
+    # label values -> (count per bucket, [sum])
+    _series: dict[LabelValues, tuple[list[int], list[float]]]
+    # label values -> observations of 0 counted elsewhere, read when rendering (see TimedLock)
+    _zeros: dict[LabelValues, list[Callable[[], int]]]
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._zeros = {}
+        self._lock = threading.Lock()
+
+    def _series_of(self, label_values: LabelValues) -> tuple[list[int], list[float]]:
+        # The caller holds the lock
+        series = self._series.get(label_values)
+        if series is None:
+            series = ([0] * (len(self.buckets) + 1), [0.0])
+            self._series[label_values] = series
+        return series
+
+    def observe(self, value: float, *label_values: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series_of(label_values)
+            series[0][i] += 1
+            series[1][0] += value
+
+    def count_zeros(self, count: Callable[[], int], *label_values: str) -> None:
+        '''
+        Add `count()` observations of 0 to the series when rendering, for a hot path that counts them without this lock.
+        '''
+        with self._lock:
+            self._series_of(label_values)
+            self._zeros.setdefault(label_values, []).append(count)
+
+    def time(self, *label_values: str) -> "_Timer":
+        return _Timer(self, label_values)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for values, (counts, total) in sorted(self._series.items()):
+                counts = list(counts)
+                counts[bisect.bisect_left(self.buckets, 0.0)] += sum(count() for count in self._zeros.get(values, ()))
+                cumulative = 0
+                for le, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le_label = f'le="{_format_value(le)}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, values, le_label)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {_format_value(total[0])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, label_values: LabelValues):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+class TimedLock:
+    '''
+    threading.Lock (or `lock`, e.g. a multiprocessing.Lock) that records how long callers
+    waited to acquire it in `wait`, under `label_values`. Acquiring it free neither reads the
+    clock nor takes the histogram lock: it is only counted (under the lock itself), as a 0.
+    '''
+    # Acquisitions that did not wait
+    free: int
+
+    def __init__(self, wait: Histogram, label_values: LabelValues = (), lock=None):
+        self._lock = lock if lock is not None else threading.Lock()
+        self.wait = wait
+        self.label_values = label_values
+        self.free = 0
+        wait.count_zeros(lambda: self.free, *label_values)
+
+    def __enter__(self) -> None:
+        if self._lock.acquire(False):
+            self.free += 1
+            return
+        start = time.perf_counter()
+        self._lock.acquire()
+        self.wait.observe(time.perf_counter() - start, *self.label_values)
+
+    def __exit__(self, *exc) -> None:
+        self._lock.release()
+
+
+class Registry:
+    _metrics: list
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, *metrics: Counter | Gauge | Histogram) -> None:
+        self._metrics.extend(metrics)
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
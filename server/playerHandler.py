@@ -1,11 +1,34 @@
+import heapq
+import itertools
+import math
 import threading
 import time
 import copy
-from dataclasses import dataclass
-from typing import Dict, Optional
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, Optional
+
+from server.metrics import Counter, Histogram, TimedLock
+from server.protocol import MAX_COORDINATE, MapTable
+from server.registryLog import RegistryLog, CHECKPOINT_INTERVAL_TIME, SYNC_INTERVAL_TIME
 
 TIMEOUT_TIME = 60.0
 CHECK_INTERVAL_TIME = 10.0
+# Side length (in pixels) of one cell of the coarse spatial grid used for area-of-interest queries
+GRID_CELL_SIZE = 512.0
+# Largest radius a client may ask for, in pixels (a radius query is a view, not a map dump)
+MAX_RADIUS = 64.0 * 64
+# How many departed players each map remembers for delta queries before older versions force a full resync
+MAX_TOMBSTONES = 1024
+# A changed view gets its cached snapshot rebuilt at most once per tick
+SNAPSHOT_INTERVAL_TIME = 0.02
+# Simulation ticks per second (0 = apply every update as it arrives)
+TICK_RATE = 20.0
+# Fastest a player may move on a map, in pixels per second (the game walks at 4 tiles of 64 pixels per second)
+MAX_SPEED = 6.0 * 64
+
+Cell = tuple[int, int]
 
 @dataclass
 class Player:
@@ -13,36 +36,283 @@ class Player:
     x: float
     y: float
     map: str
+    # When the player last moved, and when it last sent anything (moves or heartbeats keep it registered)
     last_update: float
+    # Version of the last change (for delta queries)
+    version: int = 0
+    last_seen: float = 0.0
+    # Restored from the registry and not updated since: its first move is not speed checked,
+    # so a client that moved while the server was down shows up where it is
+    restored: bool = False
+
+    def __post_init__(self):
+        self.last_seen = max(self.last_seen, self.last_update)
 
-    def update(self, x: float, y: float, map: str) -> None:
-        if x != self.x or y != self.y or map != self.map:
-            self.last_update = time.monotonic()
+    def update(self, x: float, y: float, map: str) -> bool:
+        changed = x != self.x or y != self.y or map != self.map
+        self.restored = False
+        self.last_seen = time.monotonic()
+        if changed:
+            self.last_update = self.last_seen
         self.x = x
         self.y = y
         self.map = map
+        return changed
 
-    def is_inactive(self) -> bool:
+    def is_inactive(self, timeout: float = TIMEOUT_TIME) -> bool:
         now = time.monotonic()
-        return (now - self.last_update) >= TIMEOUT_TIME
+        return (now - self.last_seen) >= timeout
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "x": self.x,
+            "y": self.y,
+            "map": self.map
+        }
+
+
+@dataclass
+class Snapshot:
+    '''
+    Immutable view of the players of one map (or of every map), shared by all readers.
+    `players` must not be modified; `encode` memoizes the serialized bytes per format.
+    '''
+    version: int
+    built_at: float
+    players: dict
+    _encoded: Dict[str, bytes] = field(default_factory=dict, repr=False)
+
+    def encode(self, fmt: str, encoder: Callable[["Snapshot"], bytes]) -> bytes:
+        data = self._encoded.get(fmt)
+        if data is None:
+            data = encoder(self)
+            self._encoded[fmt] = data
+        return data
+
+
+def parse_coordinate(value: object) -> float:
+    '''
+    float(value) for a position (or radius) sent by a client. NaN, infinities and values beyond
+    MAX_COORDINATE raise ValueError: stored, they would break the grid and every answer
+    (JSON or binary) that includes the player.
+    '''
+    coordinate = float(value)
+    if not math.isfinite(coordinate) or abs(coordinate) > MAX_COORDINATE:
+        raise ValueError(f"coordinate out of range: {value!r}")
+    return coordinate
+
+def parse_radius(value: object) -> float:
+    '''
+    parse_coordinate for a view radius, clamped to MAX_RADIUS (negative radii raise ValueError).
+    '''
+    radius = parse_coordinate(value)
+    if radius < 0:
+        raise ValueError(f"negative radius: {value!r}")
+    return min(radius, MAX_RADIUS)
+
+def _cell_of(x: float, y: float) -> Cell:
+    return (int(x // GRID_CELL_SIZE), int(y // GRID_CELL_SIZE))
+
+
+class Shard:
+    '''
+    The players of one map behind their own lock, with their spatial grid and changelog.
+    Every method expects the caller to hold `lock`.
+    '''
+    map: str
+    lock: TimedLock
+    players: Dict[int, Player]
+    # Coarse spatial grid, so radius queries only touch nearby players
+    grid: Dict[Cell, set[int]]
+    cells: Dict[int, Cell]
+    # `changelog` keeps each player id once, ordered by the version of its latest change on
+    # this map. Ids of the players that left the map (or were removed) stay as tombstones.
+    version: int
+    horizon: int
+    changelog: "OrderedDict[int, int]"
+
+    def __init__(self, map_name: str, lock_wait: Histogram):
+        self.map = map_name
+        self.lock = TimedLock(lock_wait, (map_name,))
+        self.players = {}
+        self.grid = {}
+        self.cells = {}
+        self.version = 0
+        self.horizon = 0
+        self.changelog = OrderedDict()
+
+    def touch(self, pid: int, version: int) -> None:
+        self.version = version
+        self.changelog[pid] = version
+        self.changelog.move_to_end(pid)
+        # Forget the oldest entries; anyone asking for changes older than that gets a full snapshot
+        while len(self.changelog) > len(self.players) + MAX_TOMBSTONES:
+            _, self.horizon = self.changelog.popitem(last=False)
+
+    def add(self, p: Player, version: int) -> None:
+        self.players[p.id] = p
+        cell = _cell_of(p.x, p.y)
+        self.grid.setdefault(cell, set()).add(p.id)
+        self.cells[p.id] = cell
+        p.version = version
+        self.touch(p.id, version)
+
+    def remove(self, pid: int, version: int) -> Player:
+        p = self.players.pop(pid)
+        cell = self.cells.pop(pid)
+        ids = self.grid[cell]
+        ids.discard(pid)
+        if not ids:
+            del self.grid[cell]
+        self.touch(pid, version)
+        return p
+
+    def moved(self, p: Player, version: int) -> None:
+        cell = _cell_of(p.x, p.y)
+        old_cell = self.cells[p.id]
+        if cell != old_cell:
+            ids = self.grid[old_cell]
+            ids.discard(p.id)
+            if not ids:
+                del self.grid[old_cell]
+            self.grid.setdefault(cell, set()).add(p.id)
+            self.cells[p.id] = cell
+        p.version = version
+        self.touch(p.id, version)
+
+    def changed_since(self, since: int) -> list[int]:
+        ids: list[int] = []
+        for pid, version in reversed(self.changelog.items()):
+            if version <= since:
+                break
+            ids.append(pid)
+        return ids
+
+    def is_visible(self, p: Player, x: float | None, y: float | None, radius: float | None) -> bool:
+        if radius is None or x is None or y is None:
+            return True
+        return (p.x - x) ** 2 + (p.y - y) ** 2 <= radius * radius
+
+    def visible_ids(self, x: float | None, y: float | None, radius: float | None) -> list[int]:
+        if radius is None or x is None or y is None:
+            return list(self.players)
+
+        cx0, cy0 = _cell_of(x - radius, y - radius)
+        cx1, cy1 = _cell_of(x + radius, y + radius)
+        r2 = radius * radius
+        # Go through the occupied cells instead when there are fewer of them than cells in the box
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.grid):
+            cells = [ids for (cx, cy), ids in self.grid.items() if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+        else:
+            cells = [self.grid.get((cx, cy), ()) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+        ids: list[int] = []
+        for cell in cells:
+            for pid in cell:
+                p = self.players[pid]
+                if (p.x - x) ** 2 + (p.y - y) ** 2 <= r2:
+                    ids.append(pid)
+        return ids
 
 
 class PlayerHandler:
-    _lock: threading.Lock
     _stop_event: threading.Event
     _thread: threading.Thread | None
-    
-    players: Dict[int, Player]
+    _tick_thread: threading.Thread | None
+    _log_thread: threading.Thread | None
+    timeout: float
+    check_interval: float
+    tick_rate: float
+    max_speed: float | None
+
+    # The players are sharded by map, each shard behind its own lock, so traffic on one map
+    # does not wait for another. `_where` tells which shard holds a player: it is read without
+    # a lock (and checked again once the shard is locked) and written with the shard locks held.
+    # Several shards are always locked in map name order.
+    _shards: Dict[str, Shard]
+    _shards_lock: threading.Lock
+    _where: Dict[int, str]
+    _ids: Iterator[int]
     _next_id: int
+    # Registrations and removals are logged with the shard lock held, so a checkpoint taken
+    # with every shard locked matches the log exactly (see server.registryLog)
+    registry: RegistryLog | None
+    # Map ids of the binary format, logged along with the registry: clients keep theirs across restarts
+    maps: MapTable
+    # Versions are shared by all the shards but only taken with the shard lock(s) held,
+    # so the versions recorded in one shard only go up
+    _versions: Iterator[int]
+    # (deadline, id) min-heap, one entry per player. Entries are not updated when a player
+    # moves: the cleaner re-schedules the ones that turn out not to be due yet.
+    _deadlines: list[tuple[float, int]]
+    _deadlines_lock: threading.Lock
+    # With a tick rate, updates only store the latest input of each player; the tick applies
+    # them all at once with every shard locked, then publishes the snapshots
+    _inputs: Dict[int, tuple[float, float, str]]
+    _inputs_lock: threading.Lock
+    # Cached snapshot of each view (None = every map), read without any lock
+    _snapshots: Dict[str | None, Snapshot]
+    _snapshot_lock: threading.Lock
+    # Metrics (see server.metrics)
+    lock_wait: Histogram
+    sweep_duration: Histogram
+    tick_duration: Histogram
+    checkpoint_duration: Histogram
+    registrations: Counter
+    coalesced: Counter
+    clamped: Counter
+
+    def __init__(self, *, timeout_seconds: float = TIMEOUT_TIME, check_interval_seconds: float = CHECK_INTERVAL_TIME,
+                 tick_rate: float = TICK_RATE, max_speed: float | None = MAX_SPEED, registry: RegistryLog | None = None):
+        self.lock_wait = Histogram("player_lock_wait_seconds", "Time spent waiting on the lock of each map shard", ("shard",))
+        self.sweep_duration = Histogram("cleaner_sweep_seconds", "Duration of the inactive player sweeps")
+        self.tick_duration = Histogram("tick_seconds", "Duration of the simulation ticks")
+        self.checkpoint_duration = Histogram("checkpoint_seconds", "Duration of the registry checkpoints", buckets=(0.01, 0.1, 1.0, 10.0))
+        self.registrations = Counter("registrations_total", "Players registered since the server started")
+        self.coalesced = Counter("coalesced_updates_total", "Updates replaced by a newer one before the tick applied them")
+        self.clamped = Counter("clamped_updates_total", "Updates moving faster than the maximum speed")
 
-    def __init__(self, *, timeout_seconds: float = 120.0, check_interval_seconds: float = 5.0):
-        self._lock = threading.Lock()
         self._stop_event = threading.Event()
         self._thread = None
-        
-        self.players = {}
+        self._tick_thread = None
+        self._log_thread = None
+        self.timeout = timeout_seconds
+        self.check_interval = check_interval_seconds
+        self.tick_rate = tick_rate
+        self.max_speed = max_speed
+
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+        self._where = {}
+        self._ids = itertools.count()
         self._next_id = 0
-        
+        self._versions = itertools.count(1)
+        self._deadlines = []
+        self._deadlines_lock = threading.Lock()
+        self._inputs = {}
+        self._inputs_lock = threading.Lock()
+
+        self._snapshots = {}
+        self._snapshot_lock = threading.Lock()
+
+        self.maps = MapTable()
+        self.registry = registry
+        if registry is not None:
+            self._restore(registry)
+
+    def _restore(self, registry: RegistryLog) -> None:
+        recovered = registry.recover()
+        self.maps = MapTable(recovered.maps, on_intern=registry.mapped)
+        now = time.monotonic()
+        for pid, (x, y, map_name) in recovered.players.items():
+            p = Player(pid, x, y, map_name, now, restored=True)
+            self._shard(map_name).add(p, next(self._versions))
+            self._where[pid] = map_name
+            self._deadlines.append((now + self.timeout, pid))
+        heapq.heapify(self._deadlines)
+        self._next_id = recovered.next_id
+        self._ids = itertools.count(recovered.next_id)
+
     # Threading
     def start(self) -> None:
         if self._thread and self._thread.is_alive():
@@ -50,48 +320,397 @@ class PlayerHandler:
         self._stop_event.clear()
         self._thread = threading.Thread(target=self._cleaner, name="PlayerCleaner", daemon=True)
         self._thread.start()
+        if self.tick_rate > 0:
+            self._tick_thread = threading.Thread(target=self._ticker, name="PlayerTick", daemon=True)
+            self._tick_thread.start()
+        if self.registry is not None:
+            self._log_thread = threading.Thread(target=self._log_writer, name="PlayerLog", daemon=True)
+            self._log_thread.start()
 
     def stop(self) -> None:
         self._stop_event.set()
-        if self._thread:
-            self._thread.join(timeout=2.0)
+        for thread in (self._thread, self._tick_thread, self._log_thread):
+            if thread:
+                thread.join(timeout=2.0)
+        if self.registry is not None:
+            self.checkpoint()
+            self.registry.close()
+
+    def _log_writer(self) -> None:
+        last_checkpoint = time.monotonic()
+        while not self._stop_event.wait(SYNC_INTERVAL_TIME):
+            self.registry.sync()
+            if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL_TIME:
+                self.checkpoint()
+                last_checkpoint = time.monotonic()
+
+    def checkpoint(self) -> None:
+        '''
+        Snapshot the registry (and the player positions) so recovery only replays the log written after this.
+        '''
+        with self.checkpoint_duration.time():
+            with self._all_shards_locked() as shards:
+                rows = [(p.id, p.x, p.y, p.map) for s in shards for p in s.players.values()]
+                next_id = self._next_id
+                segment = self.registry.rotate()
+            self.registry.checkpoint(segment, next_id, rows, self.maps.names)
+
+    def _ticker(self) -> None:
+        interval = 1.0 / self.tick_rate
+        next_tick = time.monotonic() + interval
+        while not self._stop_event.wait(max(0.0, next_tick - time.monotonic())):
+            with self.tick_duration.time():
+                self._tick()
+            # Skip the ticks we are late for instead of running them back to back
+            next_tick = max(next_tick + interval, time.monotonic())
+
+    def _tick(self) -> None:
+        with self._inputs_lock:
+            inputs, self._inputs = self._inputs, {}
+        for map_name in {map_name for _, _, map_name in inputs.values()}:
+            self._shard(map_name)
+
+        with self._all_shards_locked() as shards:
+            for pid, (x, y, map_name) in inputs.items():
+                old_map = self._where.get(pid)
+                if old_map is not None:
+                    self._apply(pid, x, y, self._shards[old_map], self._shards[map_name])
+            self._publish(shards)
 
     def _cleaner(self) -> None:
-        while not self._stop_event.wait(CHECK_INTERVAL_TIME):
-            now = time.monotonic()
-            to_remove: list[int] = []
-            with self._lock:
-                for pid, p in list(self.players.items()):
-                    if now - p.last_update >= TIMEOUT_TIME:
-                        to_remove.append(pid)
-                for pid in to_remove:
-                    _ = self.players.pop(pid, None)
-                    
+        while not self._stop_event.wait(self.check_interval):
+            with self.sweep_duration.time():
+                self._expire(time.monotonic())
+
+    def _expire(self, now: float) -> None:
+        due: list[int] = []
+        with self._deadlines_lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                due.append(heapq.heappop(self._deadlines)[1])
+
+        not_due: list[tuple[float, int]] = []
+        for pid in due:
+            with self._locked_shard_of(pid) as shard:
+                if shard is None:
+                    continue
+                deadline = shard.players[pid].last_seen + self.timeout
+                if deadline > now:
+                    not_due.append((deadline, pid))
+                    continue
+                shard.remove(pid, next(self._versions))
+                del self._where[pid]
+                if self.registry is not None:
+                    self.registry.removed(pid)
+
+        with self._deadlines_lock:
+            for entry in not_due:
+                heapq.heappush(self._deadlines, entry)
+
+    # Shards
+    def _shard(self, map_name: str) -> Shard:
+        shard = self._shards.get(map_name)
+        if shard is None:
+            with self._shards_lock:
+                shard = self._shards.get(map_name)
+                if shard is None:
+                    shard = Shard(map_name, self.lock_wait)
+                    self._shards[map_name] = shard
+        return shard
+
+    @contextmanager
+    def _locked_shard_of(self, pid: int) -> Iterator[Shard | None]:
+        '''
+        Lock the shard holding `pid` for the duration of the block (None if `pid` is not registered).
+        '''
+        while True:
+            map_name = self._where.get(pid)
+            if map_name is None:
+                yield None
+                return
+            shard = self._shards[map_name]
+            with shard.lock:
+                # Otherwise it switched maps meanwhile
+                if pid in shard.players:
+                    yield shard
+                    return
+
+    @contextmanager
+    def _all_shards_locked(self) -> Iterator[list[Shard]]:
+        with self._shards_lock:
+            shards = sorted(self._shards.values(), key=lambda s: s.map)
+        for shard in shards:
+            shard.lock.__enter__()
+        try:
+            yield shards
+        finally:
+            for shard in reversed(shards):
+                shard.lock.__exit__(None, None, None)
+
+    @property
+    def version(self) -> int:
+        return max((s.version for s in list(self._shards.values())), default=0)
+
+    def view_version(self, map_name: str | None = None) -> int:
+        '''
+        Version of the last change on `map_name` (None = every map), read without locking.
+        '''
+        if map_name is None:
+            return self.version
+        shard = self._shards.get(map_name)
+        return shard.version if shard else 0
+
+    def metrics(self) -> list[Counter | Histogram]:
+        return [self.registrations, self.coalesced, self.clamped, self.lock_wait, self.sweep_duration, self.tick_duration,
+                self.checkpoint_duration]
+
+    @property
+    def players(self) -> Dict[int, Player]:
+        with self._all_shards_locked() as shards:
+            return {pid: copy.copy(p) for s in shards for pid, p in s.players.items()}
+
     # API
     def register(self) -> int:
-        with self._lock:
-            pid = self._next_id
-            self._next_id += 1
-            self.players[pid] = Player(pid, 0.0, 0.0, "", time.monotonic())
-            return pid
+        pid = next(self._ids)
+        shard = self._shard("")
+        with shard.lock:
+            p = Player(pid, 0.0, 0.0, "", time.monotonic())
+            shard.add(p, next(self._versions))
+            self._where[pid] = ""
+            self._next_id = max(self._next_id, pid + 1)
+            if self.registry is not None:
+                self.registry.registered(pid)
+        with self._deadlines_lock:
+            heapq.heappush(self._deadlines, (p.last_seen + self.timeout, pid))
+        self.registrations.inc()
+        return pid
 
     def update(self, pid: int, x: float, y: float, map_name: str) -> bool:
-        with self._lock:
-            p = self.players.get(pid)
-            if not p:
+        x, y, map_name = float(x), float(y), str(map_name)
+        if self.tick_rate > 0:
+            if pid not in self._where:
                 return False
-            else:
-                p.update(float(x), float(y), str(map_name))
+            # Latest input wins, the tick applies it
+            with self._inputs_lock:
+                if pid in self._inputs:
+                    self.coalesced.inc()
+                self._inputs[pid] = (x, y, map_name)
+            return True
+
+        while True:
+            old_map = self._where.get(pid)
+            if old_map is None:
+                return False
+            src, dst = self._shards[old_map], self._shard(map_name)
+            first, second = (src, dst) if src.map <= dst.map else (dst, src)
+            with first.lock, (second.lock if second is not first else nullcontext()):
+                if pid in src.players:
+                    self._apply(pid, x, y, src, dst)
+                    return True
+
+    def repeat(self, pid: int, x: float, y: float, map_name: str) -> bool:
+        '''
+        An update repeating the last one `pid` sent (see UpdateLimiter): it only keeps the player
+        registered if it is stored there, and is applied otherwise, e.g. when max_speed clamped
+        the move it repeats.
+        '''
+        with self._locked_shard_of(pid) as shard:
+            if shard is None:
+                return False
+            p = shard.players[pid]
+            if (p.x, p.y, p.map) == (x, y, map_name):
+                p.last_seen = time.monotonic()
                 return True
+        return self.update(pid, x, y, map_name)
+
+    def _apply(self, pid: int, x: float, y: float, src: Shard, dst: Shard) -> None:
+        # The caller holds the locks of both shards
+        p = src.players[pid]
+        if src is dst:
+            x, y = self._validate(p, x, y)
+            if p.update(x, y, dst.map):
+                src.moved(p, next(self._versions))
+            return
+        # Switching maps: the player leaves a tombstone in the old shard
+        version = next(self._versions)
+        src.remove(pid, version)
+        p.update(x, y, dst.map)
+        dst.add(p, version)
+        self._where[pid] = dst.map
+
+    def _validate(self, p: Player, x: float, y: float) -> tuple[float, float]:
+        '''
+        Clamp a move on the same map to what `max_speed` allows since the last update (or heartbeat)
+        of the player: standing still does not save up distance for a later jump.
+        '''
+        if self.max_speed is None or p.restored:
+            return x, y
+        dx, dy = x - p.x, y - p.y
+        distance = math.hypot(dx, dy)
+        limit = self.max_speed * (time.monotonic() - p.last_seen)
+        if distance <= limit:
+            return x, y
+        self.clamped.inc()
+        scale = limit / distance
+        return p.x + dx * scale, p.y + dy * scale
 
     def list_players(self) -> dict:
-        with self._lock:
+        with self._all_shards_locked() as shards:
+            player_list = {}
+            for shard in shards:
+                for p in shard.players.values():
+                    player_list[p.id] = p.to_dict()
+            return player_list
+
+    def query_players(self, map_name: str, x: float | None = None, y: float | None = None,
+                      radius: float | None = None, exclude: int | None = None) -> dict:
+        '''
+        Return the players on `map_name`. If a position and a radius are given,
+        only the players within `radius` pixels of (x, y) are returned.
+        '''
+        shard = self._shards.get(map_name)
+        if shard is None:
+            return {}
+        with shard.lock:
+            player_list = {}
+            for pid in shard.visible_ids(x, y, radius):
+                if pid != exclude:
+                    player_list[pid] = shard.players[pid].to_dict()
+            return player_list
+
+    def players_near(self, pid: int, radius: float | None = None) -> Optional[dict]:
+        '''
+        Same as `query_players`, centered on the player `pid` (who is left out of the result).
+        Returns None if `pid` is not registered.
+        '''
+        with self._locked_shard_of(pid) as shard:
+            if shard is None:
+                return None
+            p = shard.players[pid]
             player_list = {}
-            for p in self.players.values():
-                player_list[p.id] = {
-                    "id": p.id,
-                    "x": p.x,
-                    "y": p.y,
-                    "map": p.map
-                }
+            for other in shard.visible_ids(p.x, p.y, radius):
+                if other != pid:
+                    player_list[other] = shard.players[other].to_dict()
             return player_list
+
+    def map_counts(self) -> dict[str, int]:
+        '''
+        Number of players on each map ("" = registered but not on a map yet).
+        '''
+        return {map_name: len(s.players) for map_name, s in list(self._shards.items()) if s.players}
+
+    def is_registered(self, pid: int) -> bool:
+        return pid in self._where
+
+    def locate(self, pid: int) -> Optional[tuple[str, float, float]]:
+        with self._locked_shard_of(pid) as shard:
+            if shard is None:
+                return None
+            p = shard.players[pid]
+            return (p.map, p.x, p.y)
+
+    def changes_since(self, since: int, map_name: str | None = None, x: float | None = None,
+                      y: float | None = None, radius: float | None = None, exclude: int | None = None) -> dict:
+        '''
+        Return what changed in the given view (see `query_players`, None = every map) after version `since`:
+        {"version": current version, "full": bool, "players": {id: player}, "removed": [id, ...]}
+        `removed` lists the players that were deleted or left the view. If `since` is too old
+        (or from the future, e.g. after a server restart) a full snapshot is returned with "full": True.
+        Deltas are computed against the view at the time of the call, so a caller whose view
+        moved must ask for a full snapshot (since=0) again.
+        The version of a map view is the version of the last change on that map.
+        '''
+        if map_name is None:
+            return self._changes_since_all(since, exclude)
+
+        shard = self._shards.get(map_name)
+        if shard is None:
+            return {"version": 0, "full": True, "players": {}, "removed": []}
+        # Nothing happened on the map since then: answer without taking the lock
+        if since > 0 and since == shard.version:
+            return {"version": since, "full": False, "players": {}, "removed": []}
+
+        with shard.lock:
+            players: dict = {}
+            removed: list[int] = []
+            full = since <= 0 or since < shard.horizon or since > shard.version
+            ids = shard.visible_ids(x, y, radius) if full else shard.changed_since(since)
+            for pid in ids:
+                if pid == exclude:
+                    continue
+                p = shard.players.get(pid)
+                if p is not None and shard.is_visible(p, x, y, radius):
+                    players[pid] = p.to_dict()
+                else:
+                    # Removed, switched maps, or out of range
+                    removed.append(pid)
+            return {"version": shard.version, "full": full, "players": players, "removed": removed}
+
+    def _changes_since_all(self, since: int, exclude: int | None) -> dict:
+        with self._all_shards_locked() as shards:
+            version = max((s.version for s in shards), default=0)
+            horizon = max((s.horizon for s in shards), default=0)
+            full = since <= 0 or since < horizon or since > version
+            players: dict = {}
+            removed: set[int] = set()
+            for shard in shards:
+                for pid in shard.players if full else shard.changed_since(since):
+                    if pid == exclude:
+                        continue
+                    if pid in shard.players:
+                        players[pid] = shard.players[pid].to_dict()
+                    elif pid not in self._where:
+                        removed.add(pid)
+            return {"version": version, "full": full, "players": players, "removed": sorted(removed)}
+
+    def snapshot(self, map_name: str | None = None) -> Snapshot:
+        '''
+        Return the cached snapshot of the players on `map_name` (None = every map).
+        Readers never take the shard locks; a snapshot whose view changed is rebuilt
+        by one reader at most once every SNAPSHOT_INTERVAL_TIME, the others keep
+        getting the previous one meanwhile. With a tick rate, each tick publishes them instead.
+        '''
+        snap = self._snapshots.get(map_name)
+        if self.tick_rate > 0:
+            # Published by the tick
+            return snap if snap is not None else Snapshot(0, 0.0, {})
+        if snap is not None and (snap.version == self.view_version(map_name)
+                                 or time.monotonic() - snap.built_at < SNAPSHOT_INTERVAL_TIME):
+            return snap
+
+        if not self._snapshot_lock.acquire(blocking=snap is None):
+            return snap
+        try:
+            current = self._snapshots.get(map_name)
+            if current is not snap and current is not None:
+                return current
+            if map_name is None:
+                with self._all_shards_locked() as shards:
+                    version = max((s.version for s in shards), default=0)
+                    rows = [(p.id, p.x, p.y, p.map) for s in shards for p in s.players.values()]
+            elif (shard := self._shards.get(map_name)) is not None:
+                with shard.lock:
+                    version = shard.version
+                    rows = [(p.id, p.x, p.y, p.map) for p in shard.players.values()]
+            else:
+                version, rows = 0, []
+            players = {pid: {"id": pid, "x": x, "y": y, "map": m} for pid, x, y, m in rows}
+            snap = Snapshot(version, time.monotonic(), players)
+            self._snapshots[map_name] = snap
+            return snap
+        finally:
+            self._snapshot_lock.release()
+
+    def _publish(self, shards: list[Shard]) -> None:
+        # The caller holds every shard lock
+        now = time.monotonic()
+        snapshots = dict(self._snapshots)
+        for shard in shards:
+            snap = snapshots.get(shard.map)
+            if snap is None or snap.version != shard.version:
+                snapshots[shard.map] = Snapshot(shard.version, now, {pid: p.to_dict() for pid, p in shard.players.items()})
+        version = max((s.version for s in shards), default=0)
+        snap = snapshots.get(None)
+        if snap is None or snap.version != version:
+            players = {pid: p for s in shards for pid, p in snapshots[s.map].players.items()}
+            snapshots[None] = Snapshot(version, now, players)
+        self._snapshots = snapshots
@@ -0,0 +1,218 @@
+import json
+import socket
+import struct
+import threading
+from typing import Callable, Iterable
+
+# Push channel framing: every message is a 4 byte big-endian length followed by a payload.
+# A payload starting with "{" is a JSON object, anything else is a binary message (see below).
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1 << 20
+
+"""
+================== BINARY FORMAT ==================
+Negotiated with "Accept: application/x-monster-go" / "Content-Type: application/x-monster-go"
+over HTTP, or {"type": "hello", "format": "binary"} on the push channel. JSON stays the fallback.
+All integers are little-endian. Map names are interned to small ids (MapTable), and coordinates
+are sent as a tile index plus a 1/256 tile offset.
+Servers only accept what these can carry: at most MAX_MAPS map names of up to 255 utf-8 bytes,
+and coordinates within MAX_COORDINATE pixels of 0 (see playerHandler.parse_coordinate).
+
+PLAYER    <I H h B h B>   id, map id, tile x, offset x, tile y, offset y           (12 bytes)
+UPDATE    kind 0x01, then one or more PLAYER records (id = the sender)
+PLAYERS   kind 0x02, <I B I I> version, flags (1 = full), player count, removed count,
+          <B> map count, then per map <H B> id, name length and the utf-8 name,
+          then the PLAYER records and the removed ids <I>
+===================================================
+"""
+CONTENT_TYPE = "application/x-monster-go"
+# Sent with every answer to an update: how often (in seconds) the client may send them
+SEND_INTERVAL_HEADER = "X-Send-Interval"
+KIND_UPDATE = 0x01
+KIND_PLAYERS = 0x02
+TILE_SIZE = 64
+SUBTILE_STEPS = 256
+
+RECORD = struct.Struct("<IHhBhB")
+SNAPSHOT_HEADER = struct.Struct("<BIBII")
+MAP_ENTRY = struct.Struct("<HB")
+REMOVED = struct.Struct("<I")
+FLAG_FULL = 0x01
+# A PLAYERS message counts its maps with a <B>, and the tile of a coordinate is a <h>
+MAX_MAPS = 255
+MAX_COORDINATE = 32767 * TILE_SIZE
+
+
+class MapTableFull(ValueError):
+    pass
+
+
+class MapTable:
+    '''
+    Interns map names to small integer ids. The server owns the numbering;
+    clients only `learn` the ids it sends them, to encode their own updates.
+    `intern` raises ValueError for a name longer than 255 bytes, and MapTableFull
+    past MAX_MAPS names. The server keeps its ids across restarts by starting from the
+    `names` it had and recording each new one with `on_intern(id, name)`.
+    '''
+    _ids: dict[str, int]
+    _names: list[str]
+    _lock: threading.Lock
+    # Called with the lock held, so in id order
+    on_intern: Callable[[int, str], None] | None
+
+    def __init__(self, names: Iterable[str] = (), on_intern: Callable[[int, str], None] | None = None):
+        self._names = list(names)
+        self._ids = {name: mid for mid, name in enumerate(self._names)}
+        self._lock = threading.Lock()
+        self.on_intern = on_intern
+
+    def intern(self, name: str) -> int:
+        mid = self._ids.get(name)
+        if mid is not None:
+            return mid
+        if len(name.encode("utf-8")) > 255:
+            raise ValueError("map name too long")
+        with self._lock:
+            if name not in self._ids:
+                if len(self._names) >= MAX_MAPS:
+                    raise MapTableFull("too many maps")
+                self._ids[name] = len(self._names)
+                self._names.append(name)
+                if self.on_intern is not None:
+                    self.on_intern(self._ids[name], name)
+            return self._ids[name]
+
+    def learn(self, mid: int, name: str) -> None:
+        self._ids[name] = mid
+
+    def id_of(self, name: str) -> int | None:
+        return self._ids.get(name)
+
+    def name_of(self, mid: int) -> str:
+        if not 0 <= mid < len(self._names):
+            raise ValueError(f"unknown map id {mid}")
+        return self._names[mid]
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._names)
+
+
+def quantize(value: float, tile_size: int = TILE_SIZE) -> tuple[int, int]:
+    steps = round(value * SUBTILE_STEPS / tile_size)
+    return steps // SUBTILE_STEPS, steps % SUBTILE_STEPS
+
+def dequantize(tile: int, offset: int, tile_size: int = TILE_SIZE) -> float:
+    return (tile * SUBTILE_STEPS + offset) * tile_size / SUBTILE_STEPS
+
+def encode_update(pid: int, x: float, y: float, map_id: int, tile_size: int = TILE_SIZE) -> bytes:
+    return bytes((KIND_UPDATE,)) + RECORD.pack(pid, map_id, *quantize(x, tile_size), *quantize(y, tile_size))
+
+def decode_updates(payload: bytes, maps: MapTable, tile_size: int = TILE_SIZE) -> list[dict]:
+    if not payload or payload[0] != KIND_UPDATE or (len(payload) - 1) % RECORD.size:
+        raise ValueError("malformed update")
+    updates = []
+    for pid, mid, tx, fx, ty, fy in RECORD.iter_unpack(payload[1:]):
+        updates.append({
+            "id": pid,
+            "x": dequantize(tx, fx, tile_size),
+            "y": dequantize(ty, fy, tile_size),
+            "map": maps.name_of(mid),
+        })
+    return updates
+
+def encode_players(delta: dict, maps: MapTable, tile_size: int = TILE_SIZE) -> bytes:
+    '''
+    Binary version of a PlayerHandler.changes_since result.
+    '''
+    players = delta["players"].values()
+    removed = delta["removed"]
+    map_ids = {p["map"]: maps.intern(p["map"]) for p in players}
+
+    out = bytearray(SNAPSHOT_HEADER.pack(
+        KIND_PLAYERS, delta["version"], FLAG_FULL if delta["full"] else 0, len(players), len(removed)
+    ))
+    out.append(len(map_ids))
+    for name, mid in map_ids.items():
+        raw = name.encode("utf-8")
+        out += MAP_ENTRY.pack(mid, len(raw)) + raw
+    for p in players:
+        out += RECORD.pack(p["id"], map_ids[p["map"]], *quantize(p["x"], tile_size), *quantize(p["y"], tile_size))
+    for pid in removed:
+        out += REMOVED.pack(pid)
+    return bytes(out)
+
+def decode_players(payload: bytes, maps: MapTable, tile_size: int = TILE_SIZE) -> dict:
+    kind, version, flags, n_players, n_removed = SNAPSHOT_HEADER.unpack_from(payload, 0)
+    if kind != KIND_PLAYERS:
+        raise ValueError("not a players message")
+    offset = SNAPSHOT_HEADER.size
+    n_maps = payload[offset]
+    offset += 1
+    names: dict[int, str] = {}
+    for _ in range(n_maps):
+        mid, length = MAP_ENTRY.unpack_from(payload, offset)
+        offset += MAP_ENTRY.size
+        names[mid] = payload[offset:offset + length].decode("utf-8")
+        maps.learn(mid, names[mid])
+        offset += length
+
+    players = {}
+    for _ in range(n_players):
+        pid, mid, tx, fx, ty, fy = RECORD.unpack_from(payload, offset)
+        offset += RECORD.size
+        players[pid] = {
+            "id": pid,
+            "x": dequantize(tx, fx, tile_size),
+            "y": dequantize(ty, fy, tile_size),
+            "map": names[mid],
+        }
+    removed = [REMOVED.unpack_from(payload, offset + i * REMOVED.size)[0] for i in range(n_removed)]
+    return {"version": version, "full": bool(flags & FLAG_FULL), "players": players, "removed": removed}
+
+# Push channel
+def encode_frame(obj: object) -> bytes:
+    if isinstance(obj, (bytes, bytearray)):
+        return HEADER.pack(len(obj)) + obj
+    payload = json.dumps(obj, separators=(",", ":")).encode("utf-8")
+    return HEADER.pack(len(payload)) + payload
+
+def decode_payload(payload: bytes, maps: MapTable | None = None, tile_size: int = TILE_SIZE) -> dict:
+    '''
+    Decode a frame payload into a message dict, whichever format it was sent in.
+    A binary UPDATE becomes {"type": "update", "updates": [...]}.
+    '''
+    if payload[:1] == b"{":
+        return json.loads(payload.decode("utf-8"))
+    if maps is None:
+        raise ValueError("binary message without a map table")
+    if payload[:1] == bytes((KIND_UPDATE,)):
+        return {"type": "update", "updates": decode_updates(payload, maps, tile_size)}
+    if payload[:1] == bytes((KIND_PLAYERS,)):
+        return {"type": "players", **decode_players(payload, maps, tile_size)}
+    raise ValueError("unknown message kind")
+
+def recv_frame(sock: socket.socket, maps: MapTable | None = None, tile_size: int = TILE_SIZE) -> dict | None:
+    '''
+    Blocking read of one frame from `sock`. Returns None when the peer closed the connection.
+    '''
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"frame too large: {length} bytes")
+    payload = _recv_exactly(sock, length)
+    if payload is None:
+        return None
+    return decode_payload(payload, maps, tile_size)
+
+def _recv_exactly(sock: socket.socket, n: int) -> bytes | None:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
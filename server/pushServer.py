@@ -0,0 +1,178 @@
+import asyncio
+import time
+from dataclasses import dataclass
+
+from server.playerHandler import PlayerHandler, parse_coordinate
+from server.rateLimiter import UpdateLimiter, LIMITED, DUPLICATE
+from server.protocol import HEADER, MAX_FRAME_SIZE, MapTable, MapTableFull, encode_frame, decode_payload, encode_players
+
+PUSH_INTERVAL_TIME = 0.05
+# An unchanged view is pushed again (an empty delta) this often, so clients see the players
+# that stopped stand still instead of extrapolating them (see online_manager.SnapshotBuffer)
+PUSH_KEEPALIVE_TIME = 0.2
+# Stop queueing snapshots for a client whose socket buffer is this full; it catches up with a later delta
+MAX_PENDING_BYTES = 256 * 1024
+
+"""
+================== PUSH PROTOCOL ==================
+One long-lived TCP connection per client, framed by server.protocol.
+Client -> Server
+    {"type": "hello", "id": N | null, "format": "json" | "binary"}
+                                                first frame; registers a new id if N is unknown
+    {"type": "update", "x": X, "y": Y, "map": M}   or a binary UPDATE (server.protocol)
+    {"type": "map", "name": M}                  asks for the id of a map, for binary updates
+                                                (known once an update put a player on it)
+Server -> Client
+    {"type": "welcome", "id": N, "format": "json" | "binary", "interval": seconds between updates}
+    {"type": "players", "version": V, "full": bool, "players": {...}, "removed": [...]}
+        or a binary PLAYERS message, pushed every tick when the client's view changed, and
+        every PUSH_KEEPALIVE_TIME otherwise (see PlayerHandler.changes_since)
+    {"type": "map", "name": M, "id": N}
+    {"type": "error", "error": "..."}
+===================================================
+"""
+
+@dataclass(eq=False)
+class Connection:
+    writer: asyncio.StreamWriter
+    pid: int = -1
+    binary: bool = False
+    version: int = 0
+    view_map: str | None = None
+    pushed: bool = False
+    pushed_at: float = 0.0
+
+
+class PushServer:
+    handler: PlayerHandler
+    maps: MapTable
+    interval: float
+    # Updates over the budget are dropped, repeated ones are not applied
+    limiter: UpdateLimiter
+    _connections: set[Connection]
+
+    def __init__(self, handler: PlayerHandler, maps: MapTable, *, interval_seconds: float = PUSH_INTERVAL_TIME,
+                 limiter: UpdateLimiter | None = None):
+        self.handler = handler
+        self.maps = maps
+        self.interval = interval_seconds
+        self.limiter = limiter if limiter is not None else UpdateLimiter()
+        self._connections = set()
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self._client, host, port)
+        async with server:
+            await asyncio.gather(server.serve_forever(), self._ticker())
+
+    # Connections
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        conn = Connection(writer)
+        try:
+            while True:
+                header = await reader.readexactly(HEADER.size)
+                (length,) = HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    break
+                msg = decode_payload(await reader.readexactly(length), self.maps)
+                self._handle(conn, msg)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, IndexError):
+            self._send(conn, {"type": "error", "error": "invalid_message"})
+        finally:
+            self._connections.discard(conn)
+            writer.close()
+
+    def _handle(self, conn: Connection, msg: dict) -> None:
+        kind = msg.get("type")
+        if kind == "hello":
+            pid = msg.get("id")
+            if not isinstance(pid, int) or self.handler.locate(pid) is None:
+                pid = self.handler.register()
+            conn.pid = pid
+            conn.binary = msg.get("format") == "binary"
+            conn.version = 0
+            conn.view_map = None
+            self._connections.add(conn)
+            self._send(conn, {"type": "welcome", "id": pid, "format": "binary" if conn.binary else "json",
+                              "interval": self.limiter.interval})
+        elif kind == "update":
+            # Binary updates carry records, the sender can only move itself
+            for u in msg.get("updates", [msg]):
+                try:
+                    x = parse_coordinate(u["x"])
+                    y = parse_coordinate(u["y"])
+                    map_name = str(u["map"])
+                except (KeyError, ValueError, TypeError):
+                    self._send(conn, {"type": "error", "error": "bad_fields"})
+                    return
+                result = self.limiter.check(conn.pid, (x, y, map_name))
+                if result == LIMITED:
+                    return
+                if not self.handler.is_registered(conn.pid):
+                    self.limiter.forget(conn.pid)
+                    self._send(conn, {"type": "error", "error": "player_not_found"})
+                    return
+                try:
+                    # See server._update
+                    self.maps.intern(map_name)
+                except MapTableFull:
+                    self._send(conn, {"type": "error", "error": "too_many_maps"})
+                    return
+                except ValueError:
+                    self._send(conn, {"type": "error", "error": "bad_fields"})
+                    return
+                if result == DUPLICATE:
+                    found = self.handler.repeat(conn.pid, x, y, map_name)
+                else:
+                    found = self.handler.update(conn.pid, x, y, map_name)
+                if not found:
+                    self.limiter.forget(conn.pid)
+                    self._send(conn, {"type": "error", "error": "player_not_found"})
+                    return
+        elif kind == "map":
+            # Only resolves, like GET /maps
+            name = str(msg.get("name", ""))
+            mid = self.maps.id_of(name)
+            if mid is None:
+                self._send(conn, {"type": "error", "error": "unknown_map", "name": name})
+            else:
+                self._send(conn, {"type": "map", "name": name, "id": mid})
+        else:
+            self._send(conn, {"type": "error", "error": "unknown_type"})
+
+    def _send(self, conn: Connection, msg: dict | bytes) -> None:
+        conn.writer.write(encode_frame(msg))
+
+    # Broadcasting
+    async def _ticker(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            for conn in list(self._connections):
+                self._push(conn)
+
+    def _push(self, conn: Connection) -> None:
+        if conn.writer.is_closing() or conn.writer.transport.get_write_buffer_size() > MAX_PENDING_BYTES:
+            return
+        where = self.handler.locate(conn.pid)
+        if where is None:
+            self._send(conn, {"type": "error", "error": "player_not_found"})
+            self._connections.discard(conn)
+            return
+        map_name, _, _ = where
+        since = conn.version if map_name == conn.view_map else 0
+        now = time.monotonic()
+        if conn.pushed and since == self.handler.view_version(map_name) and now - conn.pushed_at < PUSH_KEEPALIVE_TIME:
+            return
+
+        delta = self.handler.changes_since(since, map_name, exclude=conn.pid)
+        conn.version = delta["version"]
+        conn.view_map = map_name
+        conn.pushed = True
+        conn.pushed_at = now
+        if since == 0:
+            delta["full"] = True
+        if conn.binary:
+            self._send(conn, encode_players(delta, self.maps))
+        else:
+            self._send(conn, {"type": "players", **delta})
@@ -0,0 +1,90 @@
+import threading
+import time
+
+from server.metrics import Counter
+from server.playerHandler import TIMEOUT_TIME
+
+# Updates each player may send per second, and how many may arrive back to back
+UPDATE_RATE = 20.0
+UPDATE_BURST = 10.0
+
+ALLOWED = "allowed"
+DUPLICATE = "duplicate"
+LIMITED = "limited"
+
+State = tuple[float, float, str]
+
+
+class UpdateLimiter:
+    '''
+    Per-player token buckets for position updates. Every update takes a token (they refill at
+    `rate` per second, up to `burst`); an update repeating the player's last one is a DUPLICATE
+    the caller only has to `repeat` (see PlayerHandler.repeat). Clients are told to send every `interval` seconds.
+    With --workers every process has its own buckets.
+    '''
+    rate: float
+    burst: float
+    # id -> [tokens, last refill, last update]
+    _buckets: dict[int, list]
+    _lock: threading.Lock
+    _last_prune: float
+    # Metrics (see server.metrics)
+    limited: Counter
+    duplicates: Counter
+
+    def __init__(self, rate: float = UPDATE_RATE, burst: float = UPDATE_BURST):
+        self.limited = Counter("rate_limited_updates_total", "Updates refused because the player was over its budget")
+        self.duplicates = Counter("duplicate_updates_total", "Updates skipped because they repeated the last one")
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+
+    @property
+    def interval(self) -> float:
+        return 1.0 / self.rate if self.rate > 0 else 0.0
+
+    def check(self, pid: int, state: State) -> str:
+        if self.rate <= 0:
+            return ALLOWED
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(pid)
+            if bucket is None:
+                bucket = [self.burst, now, None]
+                self._buckets[pid] = bucket
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                result = LIMITED
+            else:
+                bucket[0] -= 1.0
+                result = DUPLICATE if bucket[2] == state else ALLOWED
+                bucket[2] = state
+            if now - self._last_prune >= TIMEOUT_TIME:
+                self._prune(now)
+
+        if result == LIMITED:
+            self.limited.inc()
+        elif result == DUPLICATE:
+            self.duplicates.inc()
+        return result
+
+    def forget(self, pid: int) -> None:
+        '''
+        Forget the last update of `pid`, e.g. when the handler did not know it.
+        '''
+        with self._lock:
+            bucket = self._buckets.get(pid)
+            if bucket is not None:
+                bucket[2] = None
+
+    def _prune(self, now: float) -> None:
+        # The caller holds the lock; a full bucket idle that long is the same as no bucket
+        self._last_prune = now
+        for pid in [pid for pid, bucket in self._buckets.items() if now - bucket[1] >= TIMEOUT_TIME]:
+            del self._buckets[pid]
+
+    def metrics(self) -> list[Counter]:
+        return [self.limited, self.duplicates]
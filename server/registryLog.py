@@ -0,0 +1,167 @@
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Iterable, TextIO
+
+"""
+================== REGISTRY LOG ==================
+Keeps the registered players, and the map ids of the binary format (clients keep both),
+across server restarts, in a directory:
+
+snapshot.json   {"segment": N, "next_id": I, "players": [[id, x, y, map], ...], "maps": [name, ...]}
+log.<N>         one line per registration ("R <id>"), removal ("X <id>") or new map id
+                ("M <id> <name as a JSON string>")
+
+The snapshot covers every log segment before N, so recovery loads it and replays
+log.N, log.N+1, ... only; a checkpoint (every CHECKPOINT_INTERVAL_TIME) starts a new
+segment, writes a new snapshot and deletes the segments it covers. Log lines are
+flushed as they are written (they survive the process) and fsynced every
+SYNC_INTERVAL_TIME (they survive the machine). A torn last line is ignored.
+==================================================
+"""
+SNAPSHOT_FILE = "snapshot.json"
+LOG_PREFIX = "log."
+CHECKPOINT_INTERVAL_TIME = 30.0
+SYNC_INTERVAL_TIME = 1.0
+
+
+@dataclass
+class Recovered:
+    next_id: int = 0
+    # id -> (x, y, map), players registered after the snapshot are at (0, 0, "")
+    players: dict[int, tuple[float, float, str]] = field(default_factory=dict)
+    # Map names by id
+    maps: list[str] = field(default_factory=list)
+
+
+class RegistryLog:
+    directory: str
+    _segment: int
+    _file: TextIO | None
+    _dirty: bool
+    _lock: threading.Lock
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._segment = 0
+        self._file = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _segments(self) -> list[int]:
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(LOG_PREFIX) and name[len(LOG_PREFIX):].isdigit():
+                segments.append(int(name[len(LOG_PREFIX):]))
+        return sorted(segments)
+
+    def recover(self) -> Recovered:
+        '''
+        Rebuild the registry from the snapshot and the log, then start a new log segment.
+        '''
+        recovered = Recovered()
+        first_segment = 0
+        try:
+            with open(self._path(SNAPSHOT_FILE), encoding="utf-8") as f:
+                data = json.load(f)
+            first_segment = int(data["segment"])
+            recovered.next_id = int(data["next_id"])
+            for pid, x, y, map_name in data["players"]:
+                recovered.players[int(pid)] = (float(x), float(y), str(map_name))
+            recovered.maps = [str(name) for name in data.get("maps", [])]
+        except FileNotFoundError:
+            pass
+
+        segments = self._segments()
+        for segment in segments:
+            if segment < first_segment:
+                continue
+            with open(self._path(f"{LOG_PREFIX}{segment}"), encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    kind, _, value = line.partition(" ")
+                    if kind == "M":
+                        mid, _, name = value.partition(" ")
+                        # Ids logged before the snapshot was taken are in it already
+                        if int(mid) == len(recovered.maps):
+                            recovered.maps.append(str(json.loads(name)))
+                        continue
+                    pid = int(value)
+                    if kind == "R":
+                        recovered.players[pid] = (0.0, 0.0, "")
+                        recovered.next_id = max(recovered.next_id, pid + 1)
+                    elif kind == "X":
+                        recovered.players.pop(pid, None)
+
+        with self._lock:
+            self._open(max(segments + [first_segment - 1]) + 1)
+        return recovered
+
+    def _open(self, segment: int) -> None:
+        # The caller holds the lock
+        self._segment = segment
+        self._file = open(self._path(f"{LOG_PREFIX}{segment}"), "a", encoding="utf-8")
+
+    def _write(self, line: str) -> None:
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line)
+            self._file.flush()
+            self._dirty = True
+
+    def registered(self, pid: int) -> None:
+        self._write(f"R {pid}\n")
+
+    def removed(self, pid: int) -> None:
+        self._write(f"X {pid}\n")
+
+    def mapped(self, mid: int, name: str) -> None:
+        self._write(f"M {mid} {json.dumps(name)}\n")
+
+    def sync(self) -> None:
+        with self._lock:
+            if self._file is not None and self._dirty:
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def rotate(self) -> int:
+        '''
+        Start a new log segment and return its number; everything logged so far is in the previous ones.
+        '''
+        with self._lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._file.close()
+            self._open(self._segment + 1)
+            self._dirty = False
+            return self._segment
+
+    def checkpoint(self, segment: int, next_id: int, players: Iterable[tuple[int, float, float, str]], maps: list[str]) -> None:
+        '''
+        Write the snapshot of the registry as of the start of `segment` (see `rotate`),
+        then delete the log segments it covers. `maps` may include ids logged after that.
+        '''
+        tmp = self._path(SNAPSHOT_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"segment": segment, "next_id": next_id, "players": list(players), "maps": maps}, f,
+                      separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(SNAPSHOT_FILE))
+        for old in self._segments():
+            if old < segment:
+                os.remove(self._path(f"{LOG_PREFIX}{old}"))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
@@ -0,0 +1,504 @@
+import math
+import mmap
+import struct
+import threading
+import time
+from dataclasses import dataclass, field
+from multiprocessing.context import ForkContext
+from typing import Dict, Optional
+
+from server.metrics import Counter, Histogram, TimedLock
+from server.playerHandler import TIMEOUT_TIME, CHECK_INTERVAL_TIME, SNAPSHOT_INTERVAL_TIME, TICK_RATE, MAX_SPEED, Snapshot
+from server.protocol import MAX_MAPS, MapTableFull
+
+"""
+================== SHARED PLAYER TABLE ==================
+Player state shared by the worker processes of `python server.py --workers N`, in an anonymous
+shared memory mapping created before forking:
+
+HEADER    <Q> version counter, then <Q Q I I> horizon, registrations, slots in use, map count
+MAP NAMES MAX_MAPS x <B 255s>   length and utf-8 name; a map id is its index
+SLOTS     capacity x SLOT (64 bytes each)
+
+SLOT      <I i Q Q d d d d H H B 3x>
+          seq, id, version, left version, x, y, last move and last heard of (time.monotonic),
+          map id, previous map id, live flag
+
+Ids are `generation * capacity + slot index`, so finding the slot of an id needs no lookup and
+a reused slot never hands out an old id again. A slot whose player expired stays as a tombstone
+for delta queries until it is reused (which moves the horizon, like MAX_TOMBSTONES does).
+
+Writers lock the slot (one of LOCK_STRIPES locks) and bump `seq` to an odd value, then take the
+next version, write the rest of the slot and only then make `seq` even again. Readers copy the
+table without locking and read again the slots whose `seq` was odd or changed during the copy,
+so every change up to the version counter read before the copy is seen, and no half-written slot.
+=========================================================
+"""
+VERSION_COUNTER = struct.Struct("<Q")
+HEADER = struct.Struct("<QQII")
+MAP_NAME = struct.Struct("<B255s")
+SLOT = struct.Struct("<IiQQddddHHB3x")
+SEQ = struct.Struct("<I")
+LOCK_STRIPES = 16
+DEFAULT_CAPACITY = 4096
+
+MAPS_OFFSET = VERSION_COUNTER.size + HEADER.size
+SLOTS_OFFSET = MAPS_OFFSET + MAX_MAPS * MAP_NAME.size
+
+# Fields of an unpacked SLOT
+SEQ_, ID, VERSION, LEFT_VERSION, X, Y, LAST_UPDATE, LAST_SEEN, MAP, PREV_MAP, LIVE = range(11)
+
+
+class TableFull(Exception):
+    pass
+
+
+class SharedTable:
+    '''
+    The shared memory mapping and the process-shared locks around it.
+    Must be created before the worker processes are forked.
+    '''
+    capacity: int
+    mem: mmap.mmap
+    alloc_lock: object
+    version_lock: object
+    slot_locks: list
+
+    def __init__(self, ctx: ForkContext, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.mem = mmap.mmap(-1, SLOTS_OFFSET + capacity * SLOT.size)
+        # Registrations, expiry and map interning
+        self.alloc_lock = ctx.Lock()
+        self.version_lock = ctx.Lock()
+        self.slot_locks = [ctx.Lock() for _ in range(LOCK_STRIPES)]
+
+    def header(self) -> tuple[int, int, int, int]:
+        return HEADER.unpack_from(self.mem, VERSION_COUNTER.size)
+
+    def set_header(self, horizon: int, registrations: int, used: int, map_count: int) -> None:
+        # The caller holds `alloc_lock`
+        HEADER.pack_into(self.mem, VERSION_COUNTER.size, horizon, registrations, used, map_count)
+
+    @property
+    def version(self) -> int:
+        return VERSION_COUNTER.unpack_from(self.mem, 0)[0]
+
+    def next_version(self) -> int:
+        with self.version_lock:
+            version = self.version + 1
+            VERSION_COUNTER.pack_into(self.mem, 0, version)
+            return version
+
+    def read_slot(self, slot: int) -> tuple:
+        offset = SLOTS_OFFSET + slot * SLOT.size
+        while True:
+            row = SLOT.unpack_from(self.mem, offset)
+            if row[SEQ_] % 2 == 0 and SEQ.unpack_from(self.mem, offset)[0] == row[SEQ_]:
+                return row
+            time.sleep(0)
+
+    def write_slot(self, slot: int, row: list, left_map: bool = False, changed: bool = True) -> int:
+        '''
+        Store `row` (with a new version unless not `changed`) in `slot`; the caller holds the slot lock.
+        `left_map` records that the player switched from `row[PREV_MAP]` to `row[MAP]`.
+        '''
+        offset = SLOTS_OFFSET + slot * SLOT.size
+        seq = SEQ.unpack_from(self.mem, offset)[0]
+        SEQ.pack_into(self.mem, offset, seq + 1)
+        if changed:
+            row[VERSION] = self.next_version()
+        if left_map:
+            row[LEFT_VERSION] = row[VERSION]
+        # The payload goes in while `seq` is still odd, the even `seq` last
+        row[SEQ_] = seq + 1
+        SLOT.pack_into(self.mem, offset, *row)
+        SEQ.pack_into(self.mem, offset, seq + 2)
+        row[SEQ_] = seq + 2
+        return row[VERSION]
+
+    def read_all(self) -> tuple[int, list[tuple]]:
+        '''
+        Consistent copy of the slots in use, along with the version it is up to date with.
+        '''
+        version = self.version
+        used = self.header()[2]
+        end = SLOTS_OFFSET + used * SLOT.size
+        data = self.mem[SLOTS_OFFSET:end]
+        again = self.mem[SLOTS_OFFSET:end]
+        rows = list(SLOT.iter_unpack(data))
+        if data != again:
+            for slot, row in enumerate(rows):
+                start = slot * SLOT.size
+                if row[SEQ_] % 2 or data[start:start + 4] != again[start:start + 4]:
+                    rows[slot] = self.read_slot(slot)
+        else:
+            for slot, row in enumerate(rows):
+                if row[SEQ_] % 2:
+                    rows[slot] = self.read_slot(slot)
+        return version, rows
+
+
+class SharedMapTable:
+    '''
+    MapTable (see server.protocol) backed by the shared table, so every worker numbers maps the same way.
+    '''
+    _table: SharedTable
+    _ids: dict[str, int]
+    _names: list[str]
+
+    def __init__(self, table: SharedTable):
+        self._table = table
+        self._ids = {}
+        self._names = []
+
+    def _refresh(self) -> None:
+        count = self._table.header()[3]
+        for mid in range(len(self._names), count):
+            length, raw = MAP_NAME.unpack_from(self._table.mem, MAPS_OFFSET + mid * MAP_NAME.size)
+            name = raw[:length].decode("utf-8")
+            self._names.append(name)
+            self._ids[name] = mid
+
+    def intern(self, name: str) -> int:
+        mid = self._ids.get(name)
+        if mid is not None:
+            return mid
+        encoded = name.encode("utf-8")
+        if len(encoded) > 255:
+            raise ValueError("map name too long")
+        with self._table.alloc_lock:
+            self._refresh()
+            mid = self._ids.get(name)
+            if mid is not None:
+                return mid
+            horizon, registrations, used, count = self._table.header()
+            if count >= MAX_MAPS:
+                raise MapTableFull("too many maps")
+            MAP_NAME.pack_into(self._table.mem, MAPS_OFFSET + count * MAP_NAME.size, len(encoded), encoded)
+            self._table.set_header(horizon, registrations, used, count + 1)
+            self._refresh()
+            return count
+
+    def learn(self, mid: int, name: str) -> None:
+        self._ids[name] = mid
+
+    def id_of(self, name: str) -> int | None:
+        if name not in self._ids:
+            self._refresh()
+        return self._ids.get(name)
+
+    def name_of(self, mid: int) -> str:
+        if mid >= len(self._names):
+            self._refresh()
+        if not 0 <= mid < len(self._names):
+            raise ValueError(f"unknown map id {mid}")
+        return self._names[mid]
+
+
+@dataclass
+class TableView:
+    '''
+    Decoded copy of the shared table, rebuilt by each worker at most once per tick.
+    '''
+    version: int
+    horizon: int
+    built_at: float
+    # map -> {id: player dict}
+    players: Dict[str, dict]
+    # map -> [(id, version, x, y)] of the live players, and [(id, version)] of the ones that left or expired
+    changes: Dict[str, list[tuple[int, int, float, float]]]
+    departures: Dict[str, list[tuple[int, int]]]
+    map_versions: Dict[str, int]
+    removed: list[tuple[int, int]]
+    snapshots: Dict[str | None, Snapshot] = field(default_factory=dict)
+
+
+class SharedPlayerHandler:
+    '''
+    PlayerHandler (see server.playerHandler) over a SharedTable, for the multi-process server.
+    Writes go straight to the shared slots (the latest one wins, so updates coalesce by
+    themselves); queries are answered from a TableView, which plays the part of the tick snapshot.
+    Only one process (the parent) should `start` the cleaner.
+    '''
+    table: SharedTable
+    maps: SharedMapTable
+    timeout: float
+    check_interval: float
+    publish_interval: float
+    max_speed: float | None
+    _stop_event: threading.Event
+    _thread: threading.Thread | None
+    _view: TableView | None
+    _view_lock: threading.Lock
+    # Metrics (see server.metrics), per process
+    lock_wait: Histogram
+    sweep_duration: Histogram
+    registrations: Counter
+    clamped: Counter
+
+    def __init__(self, table: SharedTable, *, timeout_seconds: float = TIMEOUT_TIME,
+                 check_interval_seconds: float = CHECK_INTERVAL_TIME, tick_rate: float = TICK_RATE,
+                 max_speed: float | None = MAX_SPEED):
+        self.lock_wait = Histogram("player_lock_wait_seconds", "Time spent waiting on the shared table locks", ("shard",))
+        self.sweep_duration = Histogram("cleaner_sweep_seconds", "Duration of the inactive player sweeps")
+        self.registrations = Counter("registrations_total", "Players registered since the server started")
+        self.clamped = Counter("clamped_updates_total", "Updates moving faster than the maximum speed")
+
+        self.table = table
+        self.maps = SharedMapTable(table)
+        self.timeout = timeout_seconds
+        self.check_interval = check_interval_seconds
+        self.publish_interval = 1.0 / tick_rate if tick_rate > 0 else SNAPSHOT_INTERVAL_TIME
+        self.max_speed = max_speed
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._view = None
+        self._view_lock = threading.Lock()
+        self._alloc_lock = TimedLock(self.lock_wait, ("alloc",), table.alloc_lock)
+        self._slot_locks = [TimedLock(self.lock_wait, ("slots",), lock) for lock in table.slot_locks]
+        # Where registered players wait, interned first so a full map table never stops registrations
+        self.maps.intern("")
+
+    # Threading
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._cleaner, name="PlayerCleaner", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=2.0)
+
+    def _cleaner(self) -> None:
+        while not self._stop_event.wait(self.check_interval):
+            with self.sweep_duration.time():
+                self._expire(time.monotonic())
+
+    def _expire(self, now: float) -> None:
+        _, rows = self.table.read_all()
+        for slot, row in enumerate(rows):
+            if not row[LIVE] or row[LAST_SEEN] + self.timeout > now:
+                continue
+            with self._slot_locks[slot % LOCK_STRIPES]:
+                current = list(self.table.read_slot(slot))
+                if current[LIVE] and current[LAST_SEEN] + self.timeout <= now:
+                    current[LIVE] = 0
+                    self.table.write_slot(slot, current)
+
+    # Views
+    def _current_view(self) -> TableView:
+        view = self._view
+        if view is not None and (view.version == self.table.version
+                                 or time.monotonic() - view.built_at < self.publish_interval):
+            return view
+        if not self._view_lock.acquire(blocking=view is None):
+            return view
+        try:
+            if self._view is not view and self._view is not None:
+                return self._view
+            self._view = self._build_view()
+            return self._view
+        finally:
+            self._view_lock.release()
+
+    def _build_view(self) -> TableView:
+        version, rows = self.table.read_all()
+        # Read after the slots: a slot reused during the copy has already moved the horizon
+        horizon = self.table.header()[0]
+        players: Dict[str, dict] = {}
+        changes: Dict[str, list] = {}
+        departures: Dict[str, list] = {}
+        map_versions: Dict[str, int] = {}
+        removed: list[tuple[int, int]] = []
+        name_of = self.maps.name_of
+        for row in rows:
+            pid = row[ID]
+            if not row[VERSION]:
+                # Being registered
+                continue
+            map_name = name_of(row[MAP])
+            if row[VERSION] > map_versions.get(map_name, 0):
+                map_versions[map_name] = row[VERSION]
+            if row[LIVE]:
+                players.setdefault(map_name, {})[pid] = {"id": pid, "x": row[X], "y": row[Y], "map": map_name}
+                changes.setdefault(map_name, []).append((pid, row[VERSION], row[X], row[Y]))
+            else:
+                departures.setdefault(map_name, []).append((pid, row[VERSION]))
+                removed.append((pid, row[VERSION]))
+            if row[PREV_MAP] != row[MAP] and row[LEFT_VERSION]:
+                prev_map = name_of(row[PREV_MAP])
+                departures.setdefault(prev_map, []).append((pid, row[LEFT_VERSION]))
+                if row[LEFT_VERSION] > map_versions.get(prev_map, 0):
+                    map_versions[prev_map] = row[LEFT_VERSION]
+        return TableView(version, horizon, time.monotonic(), players, changes, departures, map_versions, removed)
+
+    @property
+    def version(self) -> int:
+        return self.table.version
+
+    def view_version(self, map_name: str | None = None) -> int:
+        if map_name is None:
+            return self.version
+        return self._current_view().map_versions.get(map_name, 0)
+
+    def metrics(self) -> list[Counter | Histogram]:
+        return [self.registrations, self.clamped, self.lock_wait, self.sweep_duration]
+
+    # API
+    def register(self) -> int:
+        map_id = self.maps.intern("")
+        with self._alloc_lock:
+            horizon, registrations, used, count = self.table.header()
+            slot, tombstone = self._free_slot(used)
+            if slot is None:
+                if used >= self.table.capacity:
+                    raise TableFull()
+                slot, used, generation = used, used + 1, 0
+            else:
+                generation = self.table.read_slot(slot)[ID] // self.table.capacity + 1
+                # The tombstone in the reused slot is forgotten: older deltas need a full snapshot
+                horizon = max(horizon, tombstone)
+            self.table.set_header(horizon, registrations + 1, used, count)
+
+            pid = generation * self.table.capacity + slot
+            with self._slot_locks[slot % LOCK_STRIPES]:
+                now = time.monotonic()
+                self.table.write_slot(slot, [0, pid, 0, 0, 0.0, 0.0, now, now, map_id, map_id, 1])
+        self.registrations.inc()
+        return pid
+
+    def _free_slot(self, used: int) -> tuple[int | None, int]:
+        # Reuse the oldest tombstone, so recent departures stay in the deltas for as long as possible
+        best, best_version = None, 0
+        for slot in range(used):
+            row = self.table.read_slot(slot)
+            if not row[LIVE] and (best is None or row[VERSION] < best_version):
+                best, best_version = slot, row[VERSION]
+        return best, best_version
+
+    def update(self, pid: int, x: float, y: float, map_name: str) -> bool:
+        '''
+        See PlayerHandler.update. A map the table cannot hold raises MapTableFull (or ValueError
+        for a name too long), before anything is changed.
+        '''
+        slot = pid % self.table.capacity
+        if pid < 0 or slot >= self.table.header()[2]:
+            return False
+        x, y, map_id = float(x), float(y), self.maps.intern(str(map_name))
+        with self._slot_locks[slot % LOCK_STRIPES]:
+            row = list(self.table.read_slot(slot))
+            if row[ID] != pid or not row[LIVE]:
+                return False
+            last_seen, row[LAST_SEEN] = row[LAST_SEEN], time.monotonic()
+            if (x, y, map_id) != (row[X], row[Y], row[MAP]):
+                left_map = map_id != row[MAP]
+                if left_map:
+                    row[PREV_MAP] = row[MAP]
+                else:
+                    x, y = self._validate(row, x, y, row[LAST_SEEN] - last_seen)
+                row[X], row[Y], row[MAP], row[LAST_UPDATE] = x, y, map_id, row[LAST_SEEN]
+                self.table.write_slot(slot, row, left_map)
+            else:
+                self.table.write_slot(slot, row, changed=False)
+            return True
+
+    def repeat(self, pid: int, x: float, y: float, map_name: str) -> bool:
+        # See PlayerHandler.repeat: update only refreshes LAST_SEEN of a player already stored at (x, y, map_name)
+        return self.update(pid, x, y, map_name)
+
+    def _validate(self, row: list, x: float, y: float, elapsed: float) -> tuple[float, float]:
+        # See PlayerHandler._validate, `elapsed` is the time since the previous update or heartbeat
+        if self.max_speed is None:
+            return x, y
+        dx, dy = x - row[X], y - row[Y]
+        distance = math.hypot(dx, dy)
+        limit = self.max_speed * elapsed
+        if distance <= limit:
+            return x, y
+        self.clamped.inc()
+        scale = limit / distance
+        return row[X] + dx * scale, row[Y] + dy * scale
+
+    def is_registered(self, pid: int) -> bool:
+        return self.locate(pid) is not None
+
+    def locate(self, pid: int) -> Optional[tuple[str, float, float]]:
+        slot = pid % self.table.capacity
+        if pid < 0 or slot >= self.table.header()[2]:
+            return None
+        row = self.table.read_slot(slot)
+        if row[ID] != pid or not row[LIVE]:
+            return None
+        return (self.maps.name_of(row[MAP]), row[X], row[Y])
+
+    def list_players(self) -> dict:
+        view = self._current_view()
+        return {pid: p for players in view.players.values() for pid, p in players.items()}
+
+    def query_players(self, map_name: str, x: float | None = None, y: float | None = None,
+                      radius: float | None = None, exclude: int | None = None) -> dict:
+        view = self._current_view()
+        players = view.players.get(map_name, {})
+        if radius is None or x is None or y is None:
+            return {pid: p for pid, p in players.items() if pid != exclude}
+        r2 = radius * radius
+        return {pid: p for pid, p in players.items()
+                if pid != exclude and (p["x"] - x) ** 2 + (p["y"] - y) ** 2 <= r2}
+
+    def players_near(self, pid: int, radius: float | None = None) -> Optional[dict]:
+        where = self.locate(pid)
+        if where is None:
+            return None
+        return self.query_players(*where, radius, exclude=pid)
+
+    def map_counts(self) -> dict[str, int]:
+        return {map_name: len(players) for map_name, players in self._current_view().players.items() if players}
+
+    def changes_since(self, since: int, map_name: str | None = None, x: float | None = None,
+                      y: float | None = None, radius: float | None = None, exclude: int | None = None) -> dict:
+        '''
+        See PlayerHandler.changes_since.
+        '''
+        view = self._current_view()
+        version = view.version if map_name is None else view.map_versions.get(map_name, 0)
+        full = since <= 0 or since < view.horizon or since > view.version
+        if not full and since >= version:
+            return {"version": version, "full": False, "players": {}, "removed": []}
+
+        players: dict = {}
+        removed: list[int] = []
+        if map_name is None:
+            for other_map, changes in view.changes.items():
+                for pid, v, _, _ in changes:
+                    if pid != exclude and (full or v > since):
+                        players[pid] = view.players[other_map][pid]
+            if not full:
+                removed = [pid for pid, v in view.removed if v > since and pid != exclude]
+            return {"version": version, "full": full, "players": players, "removed": removed}
+
+        map_players = view.players.get(map_name, {})
+        r2 = radius * radius if radius is not None else None
+        for pid, v, px, py in view.changes.get(map_name, ()):
+            if pid == exclude or (not full and v <= since):
+                continue
+            if r2 is None or x is None or y is None or (px - x) ** 2 + (py - y) ** 2 <= r2:
+                players[pid] = map_players[pid]
+            elif not full:
+                removed.append(pid)
+        if not full:
+            removed += [pid for pid, v in view.departures.get(map_name, ()) if v > since and pid != exclude]
+        return {"version": version, "full": full, "players": players, "removed": removed}
+
+    def snapshot(self, map_name: str | None = None) -> Snapshot:
+        view = self._current_view()
+        snap = view.snapshots.get(map_name)
+        if snap is None:
+            if map_name is None:
+                snap = Snapshot(view.version, view.built_at, self.list_players())
+            else:
+                snap = Snapshot(view.map_versions.get(map_name, 0), view.built_at, view.players.get(map_name, {}))
+            view.snapshots[map_name] = snap
+        return snap
@@ -4,6 +4,9 @@ import json, os
 import pygame as pg
 from typing import TYPE_CHECKING
 
+from src.maps.collision import SpatialHash
+from src.maps.residency import MAP_PREFETCHER
+
 if TYPE_CHECKING:
     from src.maps.map import Map
     from src.entities.player import Player
@@ -19,6 +22,8 @@ class GameManager:
     # Map properties
     current_map_key: str
     maps: dict[str, Map]
+    # Trainers of each map as obstacles, built on first use
+    _obstacles: dict[str, SpatialHash[EnemyTrainer]]
     
     # Changing Scene properties
     should_change_scene: bool
@@ -36,10 +41,12 @@ class GameManager:
         self.player = player
         self.enemy_trainers = enemy_trainers
         self.bag = bag if bag is not None else Bag([], [])
+        self._obstacles = {}
         
         # Check If you should change scene
         self.should_change_scene = False
         self.next_map = ""
+        self.prefetch_maps()
         
     @property
     def current_map(self) -> Map:
@@ -68,15 +75,45 @@ class GameManager:
             self.should_change_scene = False
             if self.player:
                 self.player.position = self.maps[self.current_map_key].spawn
+            self.prefetch_maps()
+
+    def prefetch_maps(self) -> None:
+        '''
+        Load the current map and where its teleporters lead in the background,
+        so they are ready when first drawn (see src/maps/residency.py).
+        '''
+        current = self.maps.get(self.current_map_key)
+        if current is None:
+            return
+        MAP_PREFETCHER.request(current)
+        for tp in current.teleporters:
+            if tp.destination in self.maps:
+                MAP_PREFETCHER.request(self.maps[tp.destination])
             
     def check_collision(self, rect: pg.Rect) -> bool:
         if self.maps[self.current_map_key].check_collision(rect):
             return True
-        for entity in self.enemy_trainers[self.current_map_key]:
-            if rect.colliderect(entity.animation.rect):
-                return True
+        for _ in self._obstacles_of(self.current_map_key).query(rect):
+            return True
         
         return False
+
+    def move_obstacle(self, entity: EnemyTrainer) -> None:
+        '''
+        Keep the collision index up to date after `entity` (a trainer of the current map) moved.
+        '''
+        obstacles = self._obstacles.get(self.current_map_key)
+        if obstacles is not None and entity in obstacles:
+            obstacles.move(entity, entity.animation.rect)
+
+    def _obstacles_of(self, map_key: str) -> SpatialHash[EnemyTrainer]:
+        obstacles = self._obstacles.get(map_key)
+        if obstacles is None:
+            obstacles = SpatialHash(GameSettings.TILE_SIZE)
+            for entity in self.enemy_trainers.get(map_key, []):
+                obstacles.insert(entity, entity.animation.rect)
+            self._obstacles[map_key] = obstacles
+        return obstacles
         
     def save(self, path: str) -> None:
         try:
@@ -1,31 +1,297 @@
+import math
+import random
 import requests
+import socket
+import struct
 import threading
 import time
+from collections import deque
+from typing import Generic, TypeVar
 from src.utils import Logger, GameSettings
+from server.protocol import MapTable, encode_frame, recv_frame, encode_update
+from .online_transport import Transport, HttpTransport
 
-POLL_INTERVAL = 0.02
+# Remote players are drawn from a buffer of their positions (see SnapshotBuffer), 10 updates a second are enough.
+# While nothing changes around us, polls slow down by POLL_SLOWDOWN each time, up to POLL_MAX_INTERVAL.
+POLL_INTERVAL = 0.1
+POLL_MAX_INTERVAL = 1.0
+POLL_SLOWDOWN = 1.5
+SNAPSHOT_BUFFER_SIZE = 8
+# Waits between retries while the server is unreachable (see Backoff)
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10.0
+# Repeated failures are logged at most once per interval
+ERROR_LOG_INTERVAL = 30.0
+
+# Connection states
+REGISTERING = "registering"
+ONLINE = "online"
+BACKOFF = "backoff"
+
+T = TypeVar("T")
+
+class Mailbox(Generic[T]):
+    '''
+    A one-slot queue between the game and the I/O worker: put() never blocks and replaces
+    a value that was not taken yet, so the worker only ever sends the latest one.
+    '''
+    _value: T | None
+    _cond: threading.Condition
+
+    def __init__(self):
+        self._value = None
+        self._cond = threading.Condition()
+
+    def put(self, value: T) -> None:
+        with self._cond:
+            self._value = value
+            self._cond.notify()
+
+    def take(self, timeout: float) -> T | None:
+        with self._cond:
+            if self._value is None:
+                self._cond.wait(timeout)
+            value, self._value = self._value, None
+            return value
+
+    def clear(self) -> None:
+        with self._cond:
+            self._value = None
+
+class Backoff:
+    '''
+    Exponential backoff with jitter: after n failures in a row, wait a random time between
+    half and all of `base * 2 ** (n - 1)` (at most `maximum`), so clients that lost the
+    server together do not come back together.
+    '''
+    base: float
+    maximum: float
+    failures: int
+
+    def __init__(self, base: float = BACKOFF_BASE, maximum: float = BACKOFF_MAX):
+        self.base = base
+        self.maximum = maximum
+        self.failures = 0
+
+    def failed(self) -> float:
+        self.failures += 1
+        delay = min(self.maximum, self.base * 2 ** min(self.failures - 1, 32))
+        return random.uniform(delay / 2, delay)
+
+    def succeeded(self) -> None:
+        self.failures = 0
+
+class ErrorLog:
+    '''
+    Logs at most one failure (with the count of the others) every `interval` seconds,
+    and one line when things work again after a logged failure.
+    '''
+    interval: float
+    # Failures in a row, and whether one of them was logged
+    _failures: int
+    _logged: bool
+    _suppressed: int
+    _last_logged: float | None
+    _lock: threading.Lock
+
+    def __init__(self, interval: float = ERROR_LOG_INTERVAL):
+        self.interval = interval
+        self._failures = 0
+        self._logged = False
+        self._suppressed = 0
+        self._last_logged = None
+        self._lock = threading.Lock()
+
+    def failure(self, msg: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._failures += 1
+            if self._last_logged is not None and now - self._last_logged < self.interval:
+                self._suppressed += 1
+                return
+            if self._suppressed:
+                msg += f" ({self._suppressed} more since the last message)"
+            self._suppressed = 0
+            self._last_logged = now
+            self._logged = True
+        Logger.warning(msg)
+
+    def success(self, msg: str) -> None:
+        with self._lock:
+            failures, logged = self._failures, self._logged
+            self._failures, self._logged = 0, False
+        if logged:
+            Logger.info(f"{msg} (after {failures} failures)")
+
+class SnapshotBuffer:
+    '''
+    The last positions received for one remote player, with the time they arrived.
+    position() interpolates between them at a time in the past, or extrapolates from the
+    last two for at most `extrapolation` seconds past the newest one.
+    '''
+    map: str
+    # (time.monotonic() of arrival, x, y), oldest first. A position received again is kept
+    # once more (then only its time is refreshed): the last two being equal means it stopped,
+    # so it is not extrapolated past where it stands
+    _samples: deque[tuple[float, float, float]]
+
+    def __init__(self, map_name: str, size: int = SNAPSHOT_BUFFER_SIZE):
+        self.map = map_name
+        self._samples = deque(maxlen=size)
+
+    def push(self, t: float, x: float, y: float) -> None:
+        samples = self._samples
+        if len(samples) >= 2 and samples[-1][1:] == (x, y) and samples[-2][1:] == (x, y):
+            samples[-1] = (t, x, y)
+            return
+        samples.append((t, x, y))
+
+    def position(self, t: float, extrapolation: float) -> tuple[float, float]:
+        samples = self._samples
+        t1, x1, y1 = samples[-1]
+        if t >= t1:
+            if len(samples) < 2 or t - t1 > extrapolation:
+                return x1, y1
+            t0, x0, y0 = samples[-2]
+            # Received together (e.g. a poll answered right before a sync): no velocity to go by
+            if t1 <= t0:
+                return x1, y1
+            k = (t - t1) / (t1 - t0)
+            return x1 + (x1 - x0) * k, y1 + (y1 - y0) * k
+        # The render time is usually between the last two
+        for i in range(len(samples) - 1, 0, -1):
+            t0, x0, y0 = samples[i - 1]
+            if t0 <= t:
+                t1, x1, y1 = samples[i]
+                k = (t - t0) / (t1 - t0)
+                return x0 + (x1 - x0) * k, y0 + (y1 - y0) * k
+        return samples[0][1:]
+
+class DeadReckoning:
+    '''
+    Send policy for our position. Other players only know the positions we sent, and draw us
+    extrapolated from the last two for at most `extrapolation` seconds (see SnapshotBuffer); a
+    position is worth sending when it is more than `threshold` pixels away from where they draw us,
+    when the map changes, or when nothing was sent for `heartbeat` seconds.
+    '''
+    threshold: float
+    heartbeat: float
+    extrapolation: float
+    # Last position sent: x, y, map, time
+    _last: tuple[float, float, str, float] | None
+    _velocity: tuple[float, float]
+
+    def __init__(self, threshold: float, heartbeat: float, extrapolation: float):
+        self.threshold = threshold
+        self.heartbeat = heartbeat
+        self.extrapolation = extrapolation
+        self._last = None
+        self._velocity = (0.0, 0.0)
+
+    def predict(self, now: float) -> tuple[float, float]:
+        x, y, _, sent_at = self._last
+        dt = now - sent_at
+        if dt > self.extrapolation:
+            return x, y
+        return x + self._velocity[0] * dt, y + self._velocity[1] * dt
+
+    def due(self, state: tuple[float, float, str], now: float) -> bool:
+        x, y, map_name = state
+        if self.threshold <= 0 or self._last is None or map_name != self._last[2] \
+                or now - self._last[3] >= self.heartbeat:
+            return True
+        if (x, y) == self._last[:2]:
+            # Standing where we were sent: sending it again changes nothing for the others (the server
+            # skips it), who see the same position in their next answer and stop extrapolating
+            self._velocity = (0.0, 0.0)
+        else:
+            px, py = self.predict(now)
+            if math.hypot(x - px, y - py) > self.threshold:
+                return True
+        return False
+
+    def sent(self, state: tuple[float, float, str], now: float) -> None:
+        x, y, map_name = state
+        last = self._last
+        if last is not None and last[2] == map_name and now > last[3]:
+            self._velocity = ((x - last[0]) / (now - last[3]), (y - last[1]) / (now - last[3]))
+        else:
+            self._velocity = (0.0, 0.0)
+        self._last = (x, y, map_name, now)
+
+    def reset(self) -> None:
+        self._last = None
+        self._velocity = (0.0, 0.0)
 
 class OnlineManager:
     list_players: list[dict]
     player_id: int
     
+    # REGISTERING, ONLINE or BACKOFF (waiting to retry after a failure)
+    state: str
+
     _stop_event: threading.Event
+    # The I/O worker: registers, sends the updates of the mailbox and (over HTTP) polls,
+    # so the game thread never waits on the network
     _thread: threading.Thread | None
+    _outbox: Mailbox[tuple[float, float, str]]
+    # How the worker reaches the server (see online_transport)
+    _transport: Transport
+    # Receives from the push channel
+    _push_thread: threading.Thread | None
     _lock: threading.Lock
+    # Push channel (GameSettings.ONLINE_PUSH_ADDRESS), used instead of polling when configured
+    _sock: socket.socket | None
+    _send_lock: threading.Lock
     
-    def __init__(self):
+    def __init__(self, transport: Transport | None = None):
         self.base: str = GameSettings.ONLINE_SERVER_URL
+        self.push_address: str | None = GameSettings.ONLINE_PUSH_ADDRESS
+        self.binary: bool = GameSettings.ONLINE_BINARY_FORMAT
+        if transport is not None:
+            # e.g. a LoopbackTransport, which replaces the push channel too
+            self.push_address = None
+        self._transport = transport or HttpTransport(self.base, self.binary)
         self.player_id = -1
         self.list_players = []
+        # Last position sent to the server, used to only fetch the players around us
+        self._last_map: str | None = None
+        self._last_pos: tuple[float, float] = (0.0, 0.0)
+        # Players known in the current view, kept up to date with deltas (`?since=version`)
+        self._players: dict[int, dict] = {}
+        self._version = 0
+        self._view_map: str | None = None
+        self._view_lock = threading.Lock()
+        self._last_sync = 0.0
+        # Map ids of the binary format on the push channel, learnt from the server
+        self._maps = MapTable()
+        self._push_binary = False
+        self._maps_requested: set[str] = set()
+        # How often the server lets us send updates (it answers 429 above that)
+        self._send_interval = 0.0
+        self._last_send = 0.0
+        self._reckoning = DeadReckoning(GameSettings.ONLINE_SEND_THRESHOLD, GameSettings.ONLINE_HEARTBEAT_INTERVAL,
+                                        GameSettings.ONLINE_EXTRAPOLATION_LIMIT)
+        # Recent positions of the players in list_players, to draw them smoothly
+        self._buffers: dict[int, SnapshotBuffer] = {}
+        # Polls slow down while nothing changes
+        self._poll_interval = POLL_INTERVAL
+        self.state = REGISTERING
+        self._backoff = Backoff()
+        self._push_backoff = Backoff()
+        self._errors = ErrorLog()
 
         self._thread = None
+        self._outbox = Mailbox()
+        self._push_thread = None
         self._stop_event = threading.Event()
         self._lock = threading.Lock()
+        self._sock = None
+        self._send_lock = threading.Lock()
         
         Logger.info("OnlineManager initialized")
         
     def enter(self):
-        self.register()
         self.start()
             
     def exit(self):
@@ -35,76 +301,283 @@ class OnlineManager:
         with self._lock:
             return list(self.list_players)
 
+    def get_render_players(self) -> list[dict]:
+        '''
+        The other players where to draw them now: ONLINE_RENDER_DELAY seconds in the past,
+        in between the positions received for them.
+        '''
+        t = time.monotonic() - GameSettings.ONLINE_RENDER_DELAY
+        extrapolation = GameSettings.ONLINE_EXTRAPOLATION_LIMIT
+        with self._lock:
+            players = []
+            for pid, buf in self._buffers.items():
+                x, y = buf.position(t, extrapolation)
+                players.append({"id": pid, "x": x, "y": y, "map": buf.map})
+            return players
+
     # ------------------------------------------------------------------
     # Threading and API Calling Below
     # ------------------------------------------------------------------
     def register(self):
-        try:
-            url = f"{self.base}/register"
-            resp = requests.get(url, timeout=5)
-            resp.raise_for_status()
-            data = resp.json()
-            if resp.status_code == 200:
-                self.player_id = data["id"]
-                Logger.info(f"OnlineManager registered with id={self.player_id}")
-            else:
-                Logger.error("Registration failed:", data)
-        except Exception as e:
-            Logger.warning(f"OnlineManager registration error: {e}")
-        return
+        '''
+        Get a player id from the server; raises when it cannot be reached or is full
+        (the I/O worker retries, see Backoff).
+        '''
+        answer = self._transport.register()
+        self.player_id = int(answer.data["id"])
+        self._reckoning.reset()
+        # The server may have restarted: its versions start over
+        with self._view_lock:
+            self._version = 0
+            self._view_map = None
+        self._connected()
+        Logger.info(f"OnlineManager registered with id={self.player_id}")
 
     def update(self, x: float, y: float, map_name: str) -> bool:
+        '''
+        Hand our position to the I/O worker; returns False while we are not registered yet.
+        Never blocks: positions the worker had no time to send are replaced by newer ones,
+        and the worker only sends those DeadReckoning asks for.
+        '''
         if self.player_id == -1:
-            # Try to register again
+            # The worker registers us
             return False
         
-        url = f"{self.base}/players"
-        body = {"id": self.player_id, "x": x, "y": y, "map": map_name}
-        try:
-            resp = requests.post(url, json=body, timeout=5)
-            if resp.status_code == 200:
-                return True
-            Logger.warning(f"Update failed: {resp.status_code} {resp.text}")
-        except Exception as e:
-            if self._on_error:
-                try:
-                    self._on_error(e)
-                except Exception:
-                    pass
-            Logger.warning(f"Online update error: {e}")
-        return False
+        self._last_map = map_name
+        self._last_pos = (x, y)
+        self._outbox.put((x, y, map_name))
+        return True
+
+    def _send(self, x: float, y: float, map_name: str) -> bool:
+        if self.push_address is not None:
+            return self._push_update(x, y, map_name)
+
+        # One round trip: send our position and get back what changed around us
+        since, radius = self._view_params(map_name)
+        answer = self._transport.sync(self.player_id, x, y, map_name, since, radius)
+        if answer.send_interval is not None:
+            self._send_interval = answer.send_interval
+        if answer.status == 429:
+            # Sent too fast, the interval above slows us down
+            self._connected()
+            return False
+        if answer.status == 404:
+            # Our id expired on the server, the worker registers again
+            self._connected()
+            Logger.info(f"OnlineManager id={self.player_id} expired on the server")
+            self.player_id = -1
+            return False
+        self._apply_players(answer.data, map_name, since == 0)
+        self._last_sync = time.monotonic()
+        self._connected()
+        return True
 
     def start(self) -> None:
         if self._thread and self._thread.is_alive():
             return
         self._stop_event.clear()
+        self._outbox.clear()
+        self._reckoning.reset()
+        self._poll_interval = POLL_INTERVAL
+        self.state = REGISTERING
+        self._transport.open()
         self._thread = threading.Thread(
-            target=self._loop,
-            name="OnlineManagerPoller",
+            target=self._io_loop,
+            name="OnlineManagerIO",
             daemon=True
         )
         self._thread.start()
+        if self.push_address is not None:
+            self._push_thread = threading.Thread(
+                target=self._push_loop,
+                name="OnlineManagerPush",
+                daemon=True
+            )
+            self._push_thread.start()
 
     def stop(self) -> None:
         self._stop_event.set()
-        if self._thread and self._thread.is_alive():
-            self._thread.join(timeout=2)
+        sock = self._sock
+        if sock is not None:
+            # Unblocks the receiving thread
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread in (self._thread, self._push_thread):
+            if thread and thread.is_alive():
+                thread.join(timeout=2)
+        self._transport.close()
 
-    def _loop(self) -> None:
-        while not self._stop_event.wait(POLL_INTERVAL):
+    def _io_loop(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self._io_step()
+            except (requests.RequestException, ValueError, KeyError, struct.error) as e:
+                # Unreachable, or an answer we cannot read: wait longer after each failure in a row
+                delay = self._backoff.failed()
+                self.state = BACKOFF
+                self._errors.failure(f"OnlineManager cannot reach the server ({e}), retrying in {delay:.1f}s")
+                self._stop_event.wait(delay)
+
+    def _io_step(self) -> None:
+        # With the push channel, the server registers us when we connect
+        if self.push_address is None and self.player_id == -1:
+            self.state = REGISTERING
+            self.register()
+            return
+
+        # Keep to the interval the server asks for (it answers 429 above that)
+        wait = self._last_send + self._send_interval - time.monotonic()
+        if wait > 0:
+            self._stop_event.wait(wait)
+            return
+
+        state = self._outbox.take(POLL_INTERVAL)
+        now = time.monotonic()
+        if state is not None and self._reckoning.due(state, now):
+            self._last_send = now
+            # A position that did not get through is sent again next time
+            if self._send(*state):
+                self._reckoning.sent(state, now)
+        elif self.push_address is None and now - self._last_sync >= max(self._poll_interval, self._send_interval):
+            # Only poll when the game is not already syncing through update()
             self._fetch_players()
+
+    def _connected(self) -> None:
+        # The worker got an answer from the server
+        self._backoff.succeeded()
+        self.state = ONLINE
+        self._errors.success("OnlineManager reached the server again")
             
     def _fetch_players(self) -> None:
-        try:
-            url = f"{self.base}/players"
-            resp = requests.get(url, timeout=5)
-            resp.raise_for_status()
-            all_players = resp.json().get("players", [])
+        map_name = self._last_map
+        since, radius = self._view_params(map_name)
+        self._last_sync = time.monotonic()
+        answer = self._transport.players(map_name, *self._last_pos, radius, since)
+        changed = self._apply_players(answer.data, map_name, since == 0)
+        self._connected()
+        # Poll often while players around us move, less and less while nothing happens
+        if changed:
+            self._poll_interval = POLL_INTERVAL
+        else:
+            self._poll_interval = min(POLL_MAX_INTERVAL, self._poll_interval * POLL_SLOWDOWN)
+
+    def _view_params(self, map_name: str | None) -> tuple[int, float | None]:
+        # A delta only applies to the view it was computed for: start over when the view changes.
+        # A radius view moves with us, so it is always fetched whole.
+        radius = GameSettings.ONLINE_VIEW_RADIUS
+        with self._view_lock:
+            since = self._version if map_name == self._view_map else 0
+        if radius is not None:
+            since = 0
+        return since, radius
+
+    def _apply_players(self, data: dict, map_name: str | None, replace: bool) -> bool:
+        '''
+        Apply an answer to the view; returns whether anything in the view changed since the last one.
+        '''
+        version = int(data.get("version", 0))
+        replace = replace or bool(data.get("full"))
+        with self._view_lock:
+            # update() and the poller both apply answers; drop one that arrives after a newer one
+            if not replace and map_name == self._view_map and version < self._version:
+                return False
+            changed = map_name != self._view_map or version != self._version
+            if replace:
+                self._players = {}
+            for key, p in data.get("players", {}).items():
+                self._players[int(key)] = p
+            for key in data.get("removed", []):
+                self._players.pop(int(key), None)
+            self._version = version
+            self._view_map = map_name
 
             pid = self.player_id
-            filtered = [p for key, p in all_players.items() if int(key) != pid]
-            with self._lock:
-                self.list_players = filtered
+            others = [(key, p) for key, p in self._players.items() if key != pid]
+        now = time.monotonic()
+        with self._lock:
+            self.list_players = [p for _, p in others]
+            buffers = {}
+            for key, p in others:
+                buf = self._buffers.get(key)
+                if buf is None or buf.map != p["map"]:
+                    buf = SnapshotBuffer(p["map"])
+                buf.push(now, float(p["x"]), float(p["y"]))
+                buffers[key] = buf
+            self._buffers = buffers
+        return changed
+
+    # ------------------------------------------------------------------
+    # Push channel (python server.py --push)
+    # ------------------------------------------------------------------
+    def _push_update(self, x: float, y: float, map_name: str) -> bool:
+        sock = self._sock
+        if sock is None:
+            return False
+        try:
+            map_id = self._maps.id_of(map_name) if self._push_binary else None
+            if map_id is not None:
+                msg: dict | bytes = encode_update(self.player_id, x, y, map_id, GameSettings.TILE_SIZE)
+            else:
+                msg = {"type": "update", "x": x, "y": y, "map": map_name}
+            with self._send_lock:
+                sock.sendall(encode_frame(msg))
+                if self._push_binary and map_id is None and map_name not in self._maps_requested:
+                    self._maps_requested.add(map_name)
+                    sock.sendall(encode_frame({"type": "map", "name": map_name}))
+            return True
+        except OSError as e:
+            self._errors.failure(f"OnlineManager push update error: {e}")
+        return False
+
+    def _push_loop(self) -> None:
+        host, _, port = self.push_address.rpartition(":")
+        while not self._stop_event.is_set():
+            sock = None
+            try:
+                sock = socket.create_connection((host, int(port)), timeout=5)
+                sock.settimeout(None)
+                self._sock = sock
+                self._hello(self.player_id if self.player_id != -1 else None)
+                while (msg := recv_frame(sock, self._maps, GameSettings.TILE_SIZE)) is not None:
+                    self._on_push_message(msg)
+            except Exception as e:
+                if not self._stop_event.is_set():
+                    self.state = BACKOFF
+                    self._errors.failure(f"OnlineManager push channel error: {e}")
+            finally:
+                self._sock = None
+                if sock is not None:
+                    sock.close()
+            self._stop_event.wait(self._push_backoff.failed())
             
-        except Exception as e:
-            Logger.warning(f"OnlineManager fetch error: {e}")
\ No newline at end of file
+    def _hello(self, pid: int | None) -> None:
+        with self._send_lock:
+            fmt = "binary" if self.binary else "json"
+            self._sock.sendall(encode_frame({"type": "hello", "id": pid, "format": fmt}))
+
+    def _on_push_message(self, msg: dict) -> None:
+        kind = msg.get("type")
+        if kind == "welcome":
+            self.player_id = int(msg["id"])
+            self._reckoning.reset()
+            self._push_binary = msg.get("format") == "binary"
+            self._send_interval = float(msg.get("interval", 0.0))
+            self._push_backoff.succeeded()
+            self.state = ONLINE
+            self._errors.success("OnlineManager reached the server again")
+            Logger.info(f"OnlineManager registered with id={self.player_id}")
+        elif kind == "players":
+            self._apply_players(msg, self._last_map, False)
+        elif kind == "map":
+            self._maps.learn(int(msg["id"]), str(msg["name"]))
+        elif kind == "error":
+            if msg.get("error") == "player_not_found":
+                # Our id expired on the server, get a new one
+                self._hello(None)
+            elif msg.get("error") == "unknown_map":
+                # Our update did not reach the map yet (e.g. rate limited), ask again with the next one
+                self._maps_requested.discard(str(msg.get("name")))
+            else:
+                Logger.warning(f"OnlineManager push error: {msg.get('error')}")
@@ -0,0 +1,202 @@
+import random
+import requests
+import time
+from dataclasses import dataclass
+from typing import Protocol
+from requests.adapters import HTTPAdapter
+from src.utils import GameSettings
+from server.playerHandler import PlayerHandler
+from server.protocol import CONTENT_TYPE, SEND_INTERVAL_HEADER, MapTable, encode_update, decode_players
+from server.rateLimiter import UpdateLimiter, LIMITED, DUPLICATE
+
+"""
+================== ONLINE TRANSPORTS ==================
+How OnlineManager reaches the server (except the push channel). Every call answers like the
+HTTP endpoint it stands for, or raises requests.RequestException when the server cannot be
+reached (OnlineManager then backs off):
+
+register()                               GET /register  -> Answer(200, {"id": N})
+sync(id, x, y, map, since, radius)       POST /sync     -> Answer(200, view delta), 404 (unknown id) or 429 (too fast)
+players(map, x, y, radius, since)        GET /players   -> Answer(200, view delta)
+
+HttpTransport talks to server.py. LoopbackTransport calls a PlayerHandler in the same process,
+with optional latency, jitter and loss, to test and benchmark OnlineManager without sockets.
+=======================================================
+"""
+REQUEST_TIMEOUT = 5
+
+@dataclass
+class Answer:
+    status: int
+    data: dict
+    # How often the server lets us send updates, when it says so
+    send_interval: float | None = None
+
+class Transport(Protocol):
+    def open(self) -> None: ...
+    def close(self) -> None: ...
+    def register(self) -> Answer: ...
+    def sync(self, pid: int, x: float, y: float, map_name: str, since: int, radius: float | None) -> Answer: ...
+    def players(self, map_name: str | None, x: float, y: float, radius: float | None, since: int) -> Answer: ...
+
+class HttpTransport:
+    '''
+    server.py over one keep-alive connection, in the binary format when `binary` (falls back to JSON).
+    '''
+    base: str
+    binary: bool
+    _session: requests.Session | None
+    # Map ids of the binary format, learnt from the server
+    _maps: MapTable
+    _maps_requested: set[str]
+
+    def __init__(self, base: str, binary: bool = True):
+        self.base = base
+        self.binary = binary
+        self._session = None
+        self._maps = MapTable()
+        self._maps_requested = set()
+
+    def open(self) -> None:
+        # One keep-alive connection, shared by every request
+        self._session = requests.Session()
+        self._session.mount(self.base, HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+
+    def register(self) -> Answer:
+        resp = self._session.get(f"{self.base}/register", timeout=REQUEST_TIMEOUT)
+        resp.raise_for_status()
+        # The server may have restarted: its map ids start over
+        self._maps = MapTable()
+        self._maps_requested = set()
+        return Answer(resp.status_code, resp.json())
+
+    def sync(self, pid: int, x: float, y: float, map_name: str, since: int, radius: float | None) -> Answer:
+        url = f"{self.base}/sync"
+        map_id = self._map_id(map_name) if self.binary else None
+        if map_id is not None:
+            data = encode_update(pid, x, y, map_id, GameSettings.TILE_SIZE)
+            params: dict[str, object] = {"since": since}
+            if radius is not None:
+                params["radius"] = radius
+            resp = self._session.post(url, params=params, data=data, headers={"Content-Type": CONTENT_TYPE}, timeout=REQUEST_TIMEOUT)
+        else:
+            body = {"id": pid, "x": x, "y": y, "map": map_name, "since": since, "radius": radius}
+            resp = self._session.post(url, json=body, timeout=REQUEST_TIMEOUT)
+        interval = float(resp.headers[SEND_INTERVAL_HEADER]) if SEND_INTERVAL_HEADER in resp.headers else None
+        if resp.status_code in (404, 429):
+            return Answer(resp.status_code, {}, interval)
+        resp.raise_for_status()
+        return Answer(resp.status_code, self._decode(resp), interval)
+
+    def players(self, map_name: str | None, x: float, y: float, radius: float | None, since: int) -> Answer:
+        params: dict[str, object] = {}
+        if map_name is not None:
+            params["map"] = map_name
+            if radius is not None:
+                params["x"], params["y"] = x, y
+                params["radius"] = radius
+        params["since"] = since
+        headers = {"Accept": f"{CONTENT_TYPE}, application/json"} if self.binary else None
+        resp = self._session.get(f"{self.base}/players", params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+        resp.raise_for_status()
+        return Answer(resp.status_code, self._decode(resp))
+
+    def _decode(self, resp: requests.Response) -> dict:
+        # Servers without the binary format answer in JSON
+        if resp.headers.get("Content-Type") == CONTENT_TYPE:
+            return decode_players(resp.content, self._maps, GameSettings.TILE_SIZE)
+        return resp.json()
+
+    def _map_id(self, map_name: str) -> int | None:
+        map_id = self._maps.id_of(map_name)
+        if map_id is None and map_name not in self._maps_requested:
+            resp = self._session.get(f"{self.base}/maps", params={"name": map_name}, timeout=REQUEST_TIMEOUT)
+            # 404: nobody is on that map yet, our JSON update puts us there, ask again next time
+            if resp.status_code != 404:
+                self._maps_requested.add(map_name)
+            if resp.status_code == 200:
+                map_id = int(resp.json()["id"])
+                self._maps.learn(map_id, map_name)
+        return map_id
+
+class LoopbackTransport:
+    '''
+    The server endpoints answered by `handler` in this process (started by the caller).
+    Every call waits `latency` seconds (a round trip, half each way) plus or minus up to
+    `jitter`, and is lost with probability `loss`: it then raises requests.Timeout after the
+    outbound half, without reaching the handler. `seed` makes the delays and losses repeatable.
+    With a `limiter`, updates go through it like in server.py.
+    '''
+    handler: PlayerHandler
+    limiter: UpdateLimiter | None
+    latency: float
+    jitter: float
+    loss: float
+    _random: random.Random
+
+    def __init__(self, handler: PlayerHandler, *, latency: float = 0.0, jitter: float = 0.0, loss: float = 0.0,
+                 seed: int | None = None, limiter: UpdateLimiter | None = None):
+        self.handler = handler
+        self.limiter = limiter
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self._random = random.Random(seed)
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def register(self) -> Answer:
+        self._outbound()
+        answer = Answer(200, {"id": self.handler.register()})
+        self._inbound()
+        return answer
+
+    def sync(self, pid: int, x: float, y: float, map_name: str, since: int, radius: float | None) -> Answer:
+        self._outbound()
+        status = self._update(pid, x, y, map_name)
+        interval = self.limiter.interval if self.limiter is not None else None
+        if status != 200:
+            answer = Answer(status, {}, interval)
+        else:
+            answer = Answer(200, {"success": True, **self.handler.changes_since(since, map_name, x, y, radius, exclude=pid)}, interval)
+        self._inbound()
+        return answer
+
+    def players(self, map_name: str | None, x: float, y: float, radius: float | None, since: int) -> Answer:
+        self._outbound()
+        answer = Answer(200, self.handler.changes_since(since, map_name, x, y, radius))
+        self._inbound()
+        return answer
+
+    def _update(self, pid: int, x: float, y: float, map_name: str) -> int:
+        # See server._update
+        if self.limiter is None:
+            return 200 if self.handler.update(pid, x, y, map_name) else 404
+        result = self.limiter.check(pid, (x, y, map_name))
+        if result == LIMITED:
+            return 429
+        found = self.handler.repeat(pid, x, y, map_name) if result == DUPLICATE else self.handler.update(pid, x, y, map_name)
+        if not found:
+            self.limiter.forget(pid)
+            return 404
+        return 200
+
+    def _delay(self) -> float:
+        return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)) / 2
+
+    def _outbound(self) -> None:
+        lost = self._random.random() < self.loss
+        time.sleep(self._delay())
+        if lost:
+            raise requests.Timeout("loopback: request lost")
+
+    def _inbound(self) -> None:
+        time.sleep(self._delay())
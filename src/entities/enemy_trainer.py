@@ -65,6 +65,7 @@ class EnemyTrainer(Entity):
                 battle_scene.setup_battle("trainer", monster)
             scene_manager.change_scene("battle")
         self.animation.update_pos(self.position)
+        self.game_manager.move_obstacle(self)
 
     @override
     def draw(self, screen: pygame.Surface, camera: PositionCamera) -> None:
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import struct
+import zlib
+import pygame as pg
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+from src.utils import GameSettings, Logger
+from src.utils.loader import ASSETS_DIR
+from .collision import TileGrid
+
+"""
+================== MAP BAKE CACHE ==================
+What Map bakes from a TMX file (the tile pixels, the collision and trigger grids) is kept in
+MAP_CACHE_DIR, one file per map, so warm starts neither parse the TMX nor draw its tiles:
+
+header          <4sHHHHH32s>   b"MAPB", FORMAT, width, height, TILE_SIZE, chunk tiles, key
+collision grid  width * height bytes, one per tile (see TileGrid)
+trigger grid    width * height bytes
+chunk sizes     <I> per chunk
+chunks          the RGBA pixels of each chunk, zlib compressed, row by row (see ChunkedMap)
+
+The key is a sha256 of FORMAT, TILE_SIZE, MAP_CHUNK_TILES and the content of the TMX file,
+of the TSX files it uses and of their images: editing any of them rebakes the maps using it,
+and only those. A file that is missing, stale or unreadable is baked again; the whole file is
+read at once, and chunks are only decompressed when ChunkedMap needs them.
+
+Bump FORMAT when what is baked changes (e.g. the collision rules in Map).
+====================================================
+"""
+FORMAT = 1
+MAGIC = b"MAPB"
+HEADER = struct.Struct("<4sHHHHH32s")
+SIZE = struct.Struct("<I")
+
+@dataclass
+class BakedMap:
+    width: int
+    height: int
+    chunk_tiles: int
+    collision: TileGrid
+    trigger: TileGrid
+    # Compressed pixels of each chunk, row by row
+    chunks: list[bytes]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(chunk) for chunk in self.chunks) + len(self.collision.cells) + len(self.trigger.cells)
+
+    def chunk_surface(self, tx: int, ty: int, tw: int, th: int) -> pg.Surface:
+        columns = (self.width + self.chunk_tiles - 1) // self.chunk_tiles
+        pixels = zlib.decompress(self.chunks[(ty // self.chunk_tiles) * columns + tx // self.chunk_tiles])
+        return pg.image.frombytes(pixels, (tw * GameSettings.TILE_SIZE, th * GameSettings.TILE_SIZE), "RGBA")
+
+def _sources(tmx: Path) -> list[Path]:
+    # The TMX file, the TSX files it uses and the images of both
+    sources = [tmx]
+    pending = [tmx]
+    while pending:
+        path = pending.pop()
+        for node in ET.parse(path).getroot().iter():
+            source = node.get("source")
+            if source is None or node.tag not in ("tileset", "image"):
+                continue
+            dep = (path.parent / source).resolve()
+            if dep not in sources:
+                sources.append(dep)
+                if node.tag == "tileset":
+                    pending.append(dep)
+    return sources
+
+def map_key(path: str) -> bytes:
+    digest = hashlib.sha256(struct.pack("<HHH", FORMAT, GameSettings.TILE_SIZE, GameSettings.MAP_CHUNK_TILES))
+    for source in _sources(ASSETS_DIR / "maps" / path):
+        digest.update(source.read_bytes())
+    return digest.digest()
+
+def _cache_file(path: str) -> Path:
+    return Path(GameSettings.MAP_CACHE_DIR) / (path.replace("/", "_") + ".bin")
+
+def load(path: str, key: bytes) -> BakedMap | None:
+    try:
+        data = _cache_file(path).read_bytes()
+    except OSError:
+        return None
+    try:
+        magic, fmt, width, height, tile_size, chunk_tiles, stored = HEADER.unpack_from(data)
+        if (magic, fmt, tile_size, chunk_tiles, stored) != (MAGIC, FORMAT, GameSettings.TILE_SIZE, GameSettings.MAP_CHUNK_TILES, key):
+            return None
+        collision = TileGrid(width, height, tile_size)
+        trigger = TileGrid(width, height, tile_size)
+        offset = HEADER.size
+        n = width * height
+        collision.cells[:] = data[offset:offset + n]
+        trigger.cells[:] = data[offset + n:offset + 2 * n]
+        offset += 2 * n
+        count = ((width + chunk_tiles - 1) // chunk_tiles) * ((height + chunk_tiles - 1) // chunk_tiles)
+        sizes = [size for size, in SIZE.iter_unpack(data[offset:offset + count * SIZE.size])]
+        offset += count * SIZE.size
+        chunks = []
+        for size in sizes:
+            chunks.append(data[offset:offset + size])
+            offset += size
+        if len(sizes) != count or offset != len(data) or len(collision.cells) != n or len(trigger.cells) != n:
+            return None
+    except struct.error:
+        return None
+    return BakedMap(width, height, chunk_tiles, collision, trigger, chunks)
+
+def save(path: str, key: bytes, baked: BakedMap) -> None:
+    target = _cache_file(path)
+    parts = [
+        HEADER.pack(MAGIC, FORMAT, baked.width, baked.height, GameSettings.TILE_SIZE, baked.chunk_tiles, key),
+        bytes(baked.collision.cells),
+        bytes(baked.trigger.cells),
+        b"".join(SIZE.pack(len(chunk)) for chunk in baked.chunks),
+        *baked.chunks,
+    ]
+    try:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # Written aside then renamed, so a crash never leaves half a file behind
+        partial = target.with_suffix(".tmp")
+        partial.write_bytes(b"".join(parts))
+        os.replace(partial, target)
+    except OSError as e:
+        Logger.warning(f"Could not cache the baked map {path}: {e}")
+
+def bake_chunks(width: int, height: int, chunk_tiles: int, render: Callable[[int, int, int, int], pg.Surface]) -> list[bytes]:
+    '''
+    Every chunk drawn by `render(tx, ty, tw, th)`, compressed, row by row.
+    '''
+    chunks = []
+    for ty in range(0, height, chunk_tiles):
+        for tx in range(0, width, chunk_tiles):
+            surface = render(tx, ty, min(chunk_tiles, width - tx), min(chunk_tiles, height - ty))
+            chunks.append(zlib.compress(pg.image.tobytes(surface, "RGBA"), 1))
+    return chunks
@@ -0,0 +1,130 @@
+import itertools
+import threading
+import pygame as pg
+from collections import OrderedDict
+from typing import Callable, Iterator
+
+from src.utils import GameSettings, PositionCamera
+
+"""
+================== MAP CHUNKS ==================
+Maps are not baked into one surface (64 px per tile, 4 bytes per pixel: 40 MB for 100x100
+tiles) but into chunks of MAP_CHUNK_TILES x MAP_CHUNK_TILES tiles:
+
+- a chunk is baked the first time it comes into view;
+- every baked chunk of every map counts against one budget (MAP_CHUNK_BUDGET bytes), and the
+  least recently drawn chunks are dropped when it is exceeded (they are baked again if needed);
+- draw only blits the chunks that intersect the camera, in one Surface.blits call.
+
+The budget should hold at least the chunks of one screen, or chunks get baked every frame.
+================================================
+"""
+ChunkKey = tuple[int, int, int]
+
+class ChunkCache:
+    '''
+    The baked chunks of every map, least recently used first, within `budget` bytes.
+    '''
+    budget: int
+    used: int
+    _chunks: OrderedDict[ChunkKey, pg.Surface]
+    # Maps may release their chunks from the prefetch thread (see residency.py)
+    _lock: threading.Lock
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: ChunkKey, bake: Callable[[], pg.Surface]) -> pg.Surface:
+        with self._lock:
+            surface = self._chunks.get(key)
+            if surface is not None:
+                self._chunks.move_to_end(key)
+                return surface
+        surface = bake()
+        with self._lock:
+            if key in self._chunks:
+                # Baked by another thread meanwhile
+                return self._chunks[key]
+            self._chunks[key] = surface
+            self.used += self._size(surface)
+            while self.used > self.budget and len(self._chunks) > 1:
+                _, old = self._chunks.popitem(last=False)
+                self.used -= self._size(old)
+        return surface
+
+    def drop(self, owner: int) -> None:
+        '''
+        Forget the chunks of one map (see ChunkedMap.key).
+        '''
+        with self._lock:
+            for key in [key for key in self._chunks if key[0] == owner]:
+                self.used -= self._size(self._chunks.pop(key))
+
+    @staticmethod
+    def _size(surface: pg.Surface) -> int:
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+CHUNK_CACHE = ChunkCache(GameSettings.MAP_CHUNK_BUDGET)
+_keys = itertools.count()
+
+class ChunkedMap:
+    '''
+    Chunked drawing of one map: `bake(tx, ty, tw, th)` returns the surface of the tiles
+    (tx, ty)..(tx + tw, ty + th).
+    '''
+    key: int
+    width: int
+    height: int
+    chunk_tiles: int
+    _bake: Callable[[int, int, int, int], pg.Surface]
+    _cache: ChunkCache
+
+    def __init__(self, width: int, height: int, bake: Callable[[int, int, int, int], pg.Surface],
+                 chunk_tiles: int = GameSettings.MAP_CHUNK_TILES, cache: ChunkCache = CHUNK_CACHE):
+        self.key = next(_keys)
+        self.width = width
+        self.height = height
+        self.chunk_tiles = chunk_tiles
+        self._bake = bake
+        self._cache = cache
+
+    def draw(self, screen: pg.Surface, camera: PositionCamera) -> None:
+        chunk = self.chunk_tiles * GameSettings.TILE_SIZE
+        blits = [
+            (surface, (cx * chunk - camera.x, cy * chunk - camera.y))
+            for cx, cy, surface in self._chunks_in(pg.Rect(camera.x, camera.y, screen.get_width(), screen.get_height()))
+        ]
+        screen.blits(blits, doreturn=False)
+
+    def warm(self, area: pg.Rect) -> None:
+        '''
+        Bake the chunks intersecting `area` (in pixels) ahead of drawing them.
+        '''
+        for _ in self._chunks_in(area):
+            pass
+
+    def _chunks_in(self, area: pg.Rect) -> Iterator[tuple[int, int, pg.Surface]]:
+        chunk = self.chunk_tiles * GameSettings.TILE_SIZE
+        cx0, cy0 = max(area.left // chunk, 0), max(area.top // chunk, 0)
+        cx1 = min((area.right - 1) // chunk, (self.width - 1) // self.chunk_tiles)
+        cy1 = min((area.bottom - 1) // chunk, (self.height - 1) // self.chunk_tiles)
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                yield cx, cy, self._cache.get((self.key, cx, cy), lambda: self._bake_chunk(cx, cy))
+
+    def _bake_chunk(self, cx: int, cy: int) -> pg.Surface:
+        tx, ty = cx * self.chunk_tiles, cy * self.chunk_tiles
+        tw, th = min(self.chunk_tiles, self.width - tx), min(self.chunk_tiles, self.height - ty)
+        return self._bake(tx, ty, tw, th)
+
+    def release(self) -> None:
+        '''
+        Forget the baked chunks now (they are baked again if drawn).
+        '''
+        self._cache.drop(self.key)
+
+    def __del__(self):
+        self.release()
@@ -0,0 +1,119 @@
+import pygame as pg
+from typing import Generic, Hashable, Iterator, TypeVar
+
+T = TypeVar("T", bound=Hashable)
+
+class TileGrid:
+    '''
+    One byte per tile of a map, set where the tile is solid (or a trigger). A rect query only
+    looks at the tiles the rect overlaps, whatever the size of the map.
+    '''
+    width: int
+    height: int
+    tile_size: int
+    cells: bytearray
+
+    def __init__(self, width: int, height: int, tile_size: int):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.cells = bytearray(width * height)
+
+    def set(self, tx: int, ty: int) -> None:
+        self.cells[ty * self.width + tx] = 1
+
+    def collides(self, rect: pg.Rect) -> bool:
+        # Same as colliderect against each tile: rects that only touch an edge do not collide
+        if rect.width <= 0 or rect.height <= 0:
+            return False
+        size = self.tile_size
+        x0, x1 = max(rect.left // size, 0), min((rect.right - 1) // size, self.width - 1)
+        y0, y1 = max(rect.top // size, 0), min((rect.bottom - 1) // size, self.height - 1)
+        if x0 > x1 or y0 > y1:
+            # Off the map
+            return False
+        cells, width = self.cells, self.width
+        for ty in range(y0, y1 + 1):
+            row = ty * width
+            if any(cells[row + x0:row + x1 + 1]):
+                return True
+        return False
+
+    def rects_in(self, area: pg.Rect) -> list[pg.Rect]:
+        '''
+        The rects of the tiles set within `area` (e.g. to draw the ones on screen).
+        '''
+        size = self.tile_size
+        x0, x1 = max(area.left // size, 0), min((area.right - 1) // size, self.width - 1)
+        y0, y1 = max(area.top // size, 0), min((area.bottom - 1) // size, self.height - 1)
+        return [
+            pg.Rect(tx * size, ty * size, size, size)
+            for ty in range(y0, y1 + 1) for tx in range(x0, x1 + 1)
+            if self.cells[ty * self.width + tx]
+        ]
+
+class SpatialHash(Generic[T]):
+    '''
+    Rects of moving things (e.g. trainers) binned by cell, so a query only looks at the
+    things in the cells it overlaps.
+    '''
+    cell_size: int
+    _cells: dict[tuple[int, int], set[T]]
+    # Where each item is, and the cells it is in
+    _items: dict[T, tuple[pg.Rect, list[tuple[int, int]]]]
+
+    def __init__(self, cell_size: int):
+        self.cell_size = cell_size
+        self._cells = {}
+        self._items = {}
+
+    def _cells_of(self, rect: pg.Rect) -> list[tuple[int, int]]:
+        size = self.cell_size
+        return [
+            (cx, cy)
+            for cy in range(rect.top // size, (rect.bottom - 1) // size + 1)
+            for cx in range(rect.left // size, (rect.right - 1) // size + 1)
+        ]
+
+    def insert(self, item: T, rect: pg.Rect) -> None:
+        if item in self._items:
+            self.remove(item)
+        cells = self._cells_of(rect)
+        for cell in cells:
+            self._cells.setdefault(cell, set()).add(item)
+        self._items[item] = (pg.Rect(rect), cells)
+
+    def remove(self, item: T) -> None:
+        _, cells = self._items.pop(item)
+        for cell in cells:
+            bucket = self._cells[cell]
+            bucket.discard(item)
+            if not bucket:
+                del self._cells[cell]
+
+    def move(self, item: T, rect: pg.Rect) -> None:
+        old, cells = self._items[item]
+        if old == rect:
+            return
+        if self._cells_of(rect) == cells:
+            old.update(rect)
+            return
+        self.insert(item, rect)
+
+    def query(self, rect: pg.Rect) -> Iterator[T]:
+        '''
+        The items whose rect collides with `rect`.
+        '''
+        seen: set[T] = set()
+        for cell in self._cells_of(rect):
+            for item in self._cells.get(cell, ()):
+                if item not in seen:
+                    seen.add(item)
+                    if self._items[item][0].colliderect(rect):
+                        yield item
+
+    def __contains__(self, item: T) -> bool:
+        return item in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
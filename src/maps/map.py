@@ -1,62 +1,113 @@
 import pygame as pg
 import pytmx
+import threading
 
-from src.utils import load_tmx, Position, GameSettings, PositionCamera, Teleport
+from src.utils import load_tmx, Logger, Position, GameSettings, PositionCamera, Teleport
+from .collision import TileGrid
+from .chunks import ChunkedMap
+from .tile_atlas import TILE_ATLAS
+from .residency import MAP_RESIDENCY
+from . import bake_cache
 
 class Map:
     # Map Properties
     path_name: str
-    tmxdata: pytmx.TiledMap
+    tmxdata: pytmx.TiledMap | None  # only parsed while baking a map not in the bake cache
     # Position Argument
     spawn: Position
     teleporters: list[Teleport]
+    # Loaded on first use, and unloaded by MAP_RESIDENCY (see residency.py)
+    _lock: threading.Lock
+    # Solid and trigger tiles, and the compressed chunks
+    _baked: bake_cache.BakedMap | None
     # Rendering Properties
-    _surface: pg.Surface
-    _collision_map: list[pg.Rect]
-    _trigger_map: list[pg.Rect]
+    _chunks: ChunkedMap | None
+    _tiles: list[pg.Surface | None]  # scaled tile of each gid, while baking (see TileAtlas)
 
     def __init__(self, path: str, tp: list[Teleport], spawn: Position):
         self.path_name = path
-        self.tmxdata = load_tmx(path)
+        self.tmxdata = None
         self.spawn = spawn
         self.teleporters = tp
 
-        pixel_w = self.tmxdata.width * GameSettings.TILE_SIZE
-        pixel_h = self.tmxdata.height * GameSettings.TILE_SIZE
+        self._lock = threading.Lock()
+        self._baked = None
+        self._chunks = None
+        self._tiles = []
 
-        # Prebake the map
-        self._surface = pg.Surface((pixel_w, pixel_h), pg.SRCALPHA)
-        self._render_all_layers(self._surface)
-        
-        # Prebake the collision map
-        self._collision_map = self._create_collision_map()
-        self._trigger_map = self._create_trigger_map()
+    @property
+    def loaded(self) -> bool:
+        return self._baked is not None
+
+    def load(self) -> None:
+        '''
+        Bake the map unless it is loaded, and the chunks of a screen around the spawn point,
+        where the player arrives (safe from any thread, see MAP_PREFETCHER).
+        '''
+        _, chunks = self._resident()
+        view = pg.Rect(0, 0, GameSettings.SCREEN_WIDTH, GameSettings.SCREEN_HEIGHT)
+        view.center = (int(self.spawn.x), int(self.spawn.y))
+        chunks.warm(view)
+
+    def unload(self) -> None:
+        with self._lock:
+            if self._chunks is not None:
+                self._chunks.release()
+            self._baked = None
+            self._chunks = None
+
+    def _resident(self) -> tuple[bake_cache.BakedMap, ChunkedMap]:
+        with self._lock:
+            if self._baked is None or self._chunks is None:
+                baked = self._bake()
+                # Chunks are decompressed as they come into view
+                self._chunks = ChunkedMap(baked.width, baked.height, baked.chunk_surface, baked.chunk_tiles)
+                self._baked = baked
+            baked, chunks = self._baked, self._chunks
+        MAP_RESIDENCY.touch(self, baked.nbytes)
+        return baked, chunks
+
+    def _bake(self) -> bake_cache.BakedMap:
+        # Bake the map and the collision map, unless they are in the cache already
+        key = bake_cache.map_key(self.path_name)
+        baked = bake_cache.load(self.path_name, key)
+        if baked is not None:
+            return baked
+        Logger.info(f"Baking map: {self.path_name}")
+        self.tmxdata = load_tmx(self.path_name)
+        self._tiles = TILE_ATLAS.tiles_of(self.tmxdata)
+        width, height = self.tmxdata.width, self.tmxdata.height
+        chunks = bake_cache.bake_chunks(width, height, GameSettings.MAP_CHUNK_TILES, self._render_all_layers)
+        baked = bake_cache.BakedMap(width, height, GameSettings.MAP_CHUNK_TILES,
+                                    self._create_collision_map(), self._create_trigger_map(), chunks)
+        bake_cache.save(self.path_name, key, baked)
+        # Everything drawn is in the chunks now
+        self.tmxdata = None
+        self._tiles = []
+        return baked
 
     def update(self, dt: float):
         return
 
     def draw(self, screen: pg.Surface, camera: PositionCamera):
-        screen.blit(self._surface, camera.transform_position(Position(0, 0)))
+        baked, chunks = self._resident()
+        chunks.draw(screen, camera)
         
-        # Draw the hitboxes collision map
+        # Draw the hitboxes collision map (the part on screen)
         if GameSettings.DRAW_HITBOXES:
-            for rect in self._collision_map:
+            view = pg.Rect(camera.x, camera.y, screen.get_width(), screen.get_height())
+            for rect in baked.collision.rects_in(view):
                 pg.draw.rect(screen, (255, 0, 0), camera.transform_rect(rect), 1)
-            for rect in self._trigger_map:
+            for rect in baked.trigger.rects_in(view):
                 pg.draw.rect(screen, (0, 255, 255), camera.transform_rect(rect), 1)
         
     def check_collision(self, rect: pg.Rect) -> bool:
         '''
         [TODO HACKATHON 4]
-        Return True if collide if rect param collide with self._collision_map
-        Hint: use API colliderect and iterate each rectangle to check
+        Return True if collide if rect param collide with the collision grid
+        (only the tiles under `rect` are looked at, see TileGrid)
         '''
-        flag = False
-        for mp in self._collision_map:
-            if mp.colliderect(rect):
-                flag = True
-                return flag
-        return flag
+        return self._resident()[0].collision.collides(rect)
         
     def check_teleport(self, pos: Position) -> Teleport | None:
         '''[TODO HACKATHON 6] 
@@ -71,56 +122,54 @@ class Map:
         '''
         Check if the player triggers a special scene
         '''
-        for mp in self._trigger_map:
-            if mp.colliderect(rect):
-                # Placeholder for triggering special scene
-                return True
-        return False
+        # Placeholder for triggering special scene
+        return self._resident()[0].trigger.collides(rect)
 
-    def _render_all_layers(self, target: pg.Surface) -> None:
+    def _render_all_layers(self, tx: int, ty: int, tw: int, th: int) -> pg.Surface:
+        # Renders the tiles (tx, ty)..(tx + tw, ty + th) (a chunk)
+        target = pg.Surface((tw * GameSettings.TILE_SIZE, th * GameSettings.TILE_SIZE), pg.SRCALPHA)
         for layer in self.tmxdata.visible_layers:
             if isinstance(layer, pytmx.TiledTileLayer):
-                self._render_tile_layer(target, layer)
+                self._render_tile_layer(target, layer, tx, ty, tw, th)
             # elif isinstance(layer, pytmx.TiledImageLayer) and layer.image:
             #     target.blit(layer.image, (layer.x or 0, layer.y or 0))
+        return target
  
-    def _render_tile_layer(self, target: pg.Surface, layer: pytmx.TiledTileLayer) -> None:
-        for x, y, gid in layer:
-            if gid == 0:
-                continue
-            image = self.tmxdata.get_tile_image_by_gid(gid)
-            if image is None:
-                continue
-
-            image = pg.transform.scale(image, (GameSettings.TILE_SIZE, GameSettings.TILE_SIZE))
-            target.blit(image, (x * GameSettings.TILE_SIZE, y * GameSettings.TILE_SIZE))
+    def _render_tile_layer(self, target: pg.Surface, layer: pytmx.TiledTileLayer,
+                           tx: int, ty: int, tw: int, th: int) -> None:
+        size, tiles = GameSettings.TILE_SIZE, self._tiles
+        for y in range(ty, ty + th):
+            row = layer.data[y]
+            # One blits call per row of tiles
+            target.blits([
+                (tiles[row[x]], ((x - tx) * size, (y - ty) * size))
+                for x in range(tx, tx + tw)
+                if tiles[row[x]] is not None
+            ], doreturn=False)
     
-    def _create_collision_map(self) -> list[pg.Rect]:
-        rects = []
+    def _create_collision_map(self) -> TileGrid:
+        grid = TileGrid(self.tmxdata.width, self.tmxdata.height, GameSettings.TILE_SIZE)
         for layer in self.tmxdata.visible_layers:
             if isinstance(layer, pytmx.TiledTileLayer) and ("collision" in layer.name.lower() or "house" in layer.name.lower()):
                 for x, y, gid in layer:
                     if gid != 0 and gid != 81:
                         '''
                         [TODO HACKATHON 4]
-                        rects.append(pg.Rect(...))
-                        Append the collision rectangle to the rects[] array
-                        Remember scale the rectangle with the TILE_SIZE from settings
+                        Mark the collision tile in the grid
+                        (it is scaled with the TILE_SIZE from settings when queried)
                         '''
-                        rect = pg.Rect(x*GameSettings.TILE_SIZE, y*GameSettings.TILE_SIZE, GameSettings.TILE_SIZE, GameSettings.TILE_SIZE)
-                        rects.append(rect)
-        return rects
+                        grid.set(x, y)
+        return grid
 
-    def _create_trigger_map(self) -> list[pg.Rect]:
-        rects = []
+    def _create_trigger_map(self) -> TileGrid:
+        grid = TileGrid(self.tmxdata.width, self.tmxdata.height, GameSettings.TILE_SIZE)
         for layer in self.tmxdata.visible_layers:
             if isinstance(layer, pytmx.TiledTileLayer):
                 if "pokemonbush" in layer.name.lower():
                     for x, y, gid in layer:
                         if gid != 0 and gid == 81:
-                            rect = pg.Rect(x*GameSettings.TILE_SIZE, y*GameSettings.TILE_SIZE, GameSettings.TILE_SIZE, GameSettings.TILE_SIZE)
-                            rects.append(rect)
-        return rects
+                            grid.set(x, y)
+        return grid
 
     @classmethod
     def from_dict(cls, data: dict) -> "Map":
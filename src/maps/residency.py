@@ -0,0 +1,87 @@
+from __future__ import annotations
+import queue
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from src.utils import GameSettings, Logger
+
+if TYPE_CHECKING:
+    from .map import Map
+
+"""
+================== MAP RESIDENCY ==================
+Maps are cheap until used: Map.load bakes one (or reads it from the bake cache) the first
+time it is drawn or queried, and MAP_RESIDENCY keeps the loaded ones within MAP_RESIDENT_BUDGET
+bytes, unloading the least recently used first (except the one just used). An unloaded map
+is loaded again when needed.
+
+MAP_PREFETCHER loads maps on a background thread, e.g. where the teleporters of the current
+map lead, so walking into one does not wait for the bake. The budget should hold a map and
+its neighbours, or they get unloaded while being prefetched.
+===================================================
+"""
+
+class MapResidency:
+    '''
+    The loaded maps, least recently used first, within `budget` bytes.
+    '''
+    budget: int
+    used: int
+    _maps: OrderedDict[Map, int]
+    _lock: threading.Lock
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def touch(self, m: Map, size: int) -> None:
+        with self._lock:
+            self.used += size - self._maps.get(m, 0)
+            self._maps[m] = size
+            self._maps.move_to_end(m)
+            while self.used > self.budget and len(self._maps) > 1:
+                old, old_size = self._maps.popitem(last=False)
+                self.used -= old_size
+                old.unload()
+
+class MapPrefetcher:
+    '''
+    Loads the requested maps one by one on a daemon thread, started on the first request.
+    '''
+    _queue: queue.Queue[Map]
+    _pending: set[Map]
+    _lock: threading.Lock
+    _thread: threading.Thread | None
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def request(self, m: Map) -> None:
+        with self._lock:
+            if m.loaded or m in self._pending:
+                return
+            self._pending.add(m)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="map-prefetch", daemon=True)
+                self._thread.start()
+        self._queue.put(m)
+
+    def _run(self) -> None:
+        while True:
+            m = self._queue.get()
+            try:
+                m.load()
+            except Exception as e:
+                # The game thread loads it again (and fails loudly) if it needs it
+                Logger.warning(f"Failed to prefetch map {m.path_name}: {e}")
+            with self._lock:
+                self._pending.discard(m)
+
+MAP_RESIDENCY = MapResidency(GameSettings.MAP_RESIDENT_BUDGET)
+MAP_PREFETCHER = MapPrefetcher()
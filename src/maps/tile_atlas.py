@@ -0,0 +1,41 @@
+import os
+import pygame as pg
+import pytmx
+
+from src.utils import GameSettings
+
+class TileAtlas:
+    '''
+    The tiles of every tileset, scaled to TILE_SIZE once and shared by every map using that
+    tileset. pytmx numbers tiles per map, so each map gets a lookup from its own gids.
+    '''
+    # (tileset image, tile id, flip flags, TILE_SIZE) -> scaled tile
+    _tiles: dict[tuple[str, int, tuple[bool, bool, bool], int], pg.Surface]
+
+    def __init__(self):
+        self._tiles = {}
+
+    def tiles_of(self, tmxdata: pytmx.TiledMap) -> list[pg.Surface | None]:
+        '''
+        The scaled tile of each gid of `tmxdata` (None for gid 0 and tiles without an image).
+        '''
+        size = GameSettings.TILE_SIZE
+        folder = os.path.dirname(tmxdata.filename)
+        tilesets = sorted(tmxdata.tilesets, key=lambda ts: ts.firstgid)
+        # pytmx gives each flipped variant of a tile its own gid, and the image flipped already
+        flags_of = {gid: flags for variants in tmxdata.gidmap.values() for gid, flags in variants}
+        tiles: list[pg.Surface | None] = []
+        for gid, image in enumerate(tmxdata.images):
+            if not image:
+                tiles.append(None)
+                continue
+            tiled_gid = tmxdata.tiledgidmap[gid]
+            tileset = [ts for ts in tilesets if ts.firstgid <= tiled_gid][-1]
+            key = (os.path.normpath(os.path.join(folder, tileset.source)), tiled_gid - tileset.firstgid, tuple(flags_of[gid]), size)
+            tile = self._tiles.get(key)
+            if tile is None:
+                tile = self._tiles[key] = pg.transform.scale(image, (size, size))
+            tiles.append(tile)
+        return tiles
+
+TILE_ATLAS = TileAtlas()
@@ -6,7 +6,7 @@ from src.scenes.scene import Scene
 from src.core import GameManager, OnlineManager
 from src.utils import Logger, PositionCamera, GameSettings, Position
 from src.core.services import sound_manager, scene_manager, input_manager
-from src.sprites import Sprite
+from src.sprites import Sprite, AvatarGroup
 from typing import override
 from src.interface.components import Button, ToggleButton, Slider
 from src.interface.backpack_ui import BackpackUI
@@ -17,7 +17,7 @@ from src.data.monster_factory import MonsterFactory
 class GameScene(Scene):
     game_manager: GameManager
     online_manager: OnlineManager | None
-    sprite_online: Sprite
+    online_players: AvatarGroup
     
     inv_button: Button
     settings_button: Button
@@ -44,7 +44,7 @@ class GameScene(Scene):
             self.online_manager = OnlineManager()
         else:
             self.online_manager = None
-        self.sprite_online = Sprite("ingame_ui/options1.png", (GameSettings.TILE_SIZE, GameSettings.TILE_SIZE))
+        self.online_players = AvatarGroup()
         
         self.active_overlay: str | None = None
 
@@ -143,6 +143,10 @@ class GameScene(Scene):
                 self.game_manager.player.position.y,
                 self.game_manager.current_map.path_name
             )
+            self.online_players.update(
+                self.online_manager.get_render_players(),
+                self.game_manager.current_map.path_name, dt
+            )
         if self.active_overlay == "settings":
             self.back_button.update(dt)
             self.settings_ui.update(dt)
@@ -172,6 +176,8 @@ class GameScene(Scene):
             self.game_manager.current_map.draw(screen, camera)
         for enemy in self.game_manager.current_enemy_trainers:
             enemy.draw(screen, camera)
+        if self.online_manager and self.game_manager.player:
+            self.online_players.draw(screen, camera)
 
         self.game_manager.bag.draw(screen)
         
@@ -189,14 +195,3 @@ class GameScene(Scene):
         else:
             self.inv_button.draw(screen)
             self.settings_button.draw(screen)
-            
-            
-        
-        if self.online_manager and self.game_manager.player:
-            list_online = self.online_manager.get_list_players()
-            for player in list_online:
-                if player["map"] == self.game_manager.current_map.path_name:
-                    cam = self.game_manager.player.camera
-                    pos = cam.transform_position_as_position(Position(player["x"], player["y"]))
-                    self.sprite_online.update_pos(pos)
-                    self.sprite_online.draw(screen)
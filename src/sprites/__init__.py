@@ -1,3 +1,4 @@
 from .sprite import Sprite
 from .background import BackgroundSprite
-from .animation import Animation
\ No newline at end of file
+from .animation import Animation
+from .avatar_group import AvatarGroup
\ No newline at end of file
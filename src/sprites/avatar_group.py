@@ -0,0 +1,87 @@
+import pygame as pg
+
+from .animation import Animation
+from src.utils import GameSettings, PositionCamera
+
+class Avatar:
+    '''
+    Where one remote player is and how it is animated; pooled by AvatarGroup.
+    '''
+    id: int
+    x: float
+    y: float
+    row: str            # animation row, the direction it last moved in
+    accumulator: float  # time into the walk cycle, 0 when standing still
+
+    def reset(self, pid: int, x: float, y: float) -> None:
+        self.id = pid
+        self.x = x
+        self.y = y
+        self.row = "down"
+        self.accumulator = 0.0
+
+    def move(self, x: float, y: float, dt: float, loop: float) -> None:
+        dx, dy = x - self.x, y - self.y
+        self.x = x
+        self.y = y
+        if abs(dx) < 0.01 and abs(dy) < 0.01:
+            self.accumulator = 0.0
+            return
+        if abs(dx) > abs(dy):
+            self.row = "right" if dx > 0 else "left"
+        else:
+            self.row = "down" if dy > 0 else "up"
+        self.accumulator = (self.accumulator + dt) % loop
+
+class AvatarGroup:
+    '''
+    The other players on the current map. They share one set of animation frames, and draw()
+    only blits those inside the camera, all in a single Surface.blits call.
+    '''
+    frames: dict[str, list[pg.Surface]]
+    loop: float
+    n_keyframes: int
+    avatars: dict[int, Avatar]
+    # Avatars of players that left, reused for the next ones
+    _pool: list[Avatar]
+
+    def __init__(
+        self, image_path: str = "character/ow1.png",
+        rows: list[str] = ["down", "left", "right", "up"], n_keyframes: int = 4,
+        loop: float = 1
+    ):
+        animation = Animation(image_path, rows, n_keyframes, (GameSettings.TILE_SIZE, GameSettings.TILE_SIZE), loop)
+        self.frames = animation.animations
+        self.loop = loop
+        self.n_keyframes = n_keyframes
+        self.avatars = {}
+        self._pool = []
+
+    def update(self, players: list[dict], map_name: str, dt: float) -> None:
+        gone = set(self.avatars)
+        for p in players:
+            if p["map"] != map_name:
+                continue
+            pid = int(p["id"])
+            avatar = self.avatars.get(pid)
+            if avatar is None:
+                avatar = self._pool.pop() if self._pool else Avatar()
+                avatar.reset(pid, float(p["x"]), float(p["y"]))
+                self.avatars[pid] = avatar
+            else:
+                gone.discard(pid)
+                avatar.move(float(p["x"]), float(p["y"]), dt, self.loop)
+        for pid in gone:
+            self._pool.append(self.avatars.pop(pid))
+
+    def draw(self, screen: pg.Surface, camera: PositionCamera) -> None:
+        size = GameSettings.TILE_SIZE
+        left, top = camera.x - size, camera.y - size
+        right, bottom = camera.x + screen.get_width(), camera.y + screen.get_height()
+        frames, scale = self.frames, self.n_keyframes / self.loop
+        blits = [
+            (frames[a.row][int(a.accumulator * scale)], (int(a.x) - camera.x, int(a.y) - camera.y))
+            for a in self.avatars.values()
+            if left < a.x < right and top < a.y < bottom
+        ]
+        screen.blits(blits, doreturn=False)
@@ -10,11 +10,22 @@ class Settings:
     DEBUG: bool = True          # Debug mode
     TILE_SIZE: int = 64         # Size of each tile in pixels
     DRAW_HITBOXES: bool = True  # Draw hitboxes for debugging
+    MAP_CHUNK_TILES: int = 16   # Maps are baked and drawn in chunks of this many tiles square
+    MAP_CHUNK_BUDGET: int = 64 * 1024 * 1024  # Bytes of baked chunks kept, for every map together
+    MAP_CACHE_DIR: str = "cache/maps"  # Where baked maps are kept between runs (see src/maps/bake_cache.py)
+    MAP_RESIDENT_BUDGET: int = 16 * 1024 * 1024  # Bytes of loaded maps kept (see src/maps/residency.py)
     # Audio
     MAX_CHANNELS: int = 16
     AUDIO_VOLUME: float = 0.5   # Volume of audio
     # Online
     IS_ONLINE: bool = False
     ONLINE_SERVER_URL: str = "http://localhost:8989"
+    ONLINE_PUSH_ADDRESS: str | None = None  # "host:port" of the push channel (server.py --push), None = HTTP polling
+    ONLINE_BINARY_FORMAT: bool = True       # Ask the server for the compact binary format (falls back to JSON)
+    ONLINE_VIEW_RADIUS: float | None = None  # Only fetch players within this many pixels (None = whole map)
+    ONLINE_SEND_THRESHOLD: float = 4.0      # Send our position when it is this many pixels off the predicted one (0 = always)
+    ONLINE_HEARTBEAT_INTERVAL: float = 5.0  # Send it anyway after this many seconds, so the server keeps us registered
+    ONLINE_RENDER_DELAY: float = 0.1        # Draw other players this many seconds in the past, between the positions received
+    ONLINE_EXTRAPOLATION_LIMIT: float = 0.25  # Keep them moving at most this long past their last position (the send threshold assumes the same)
     
 GameSettings = Settings()
\ No newline at end of file
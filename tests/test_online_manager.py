@@ -0,0 +1,97 @@
+import time
+
+from server.playerHandler import PlayerHandler
+from server.rateLimiter import UpdateLimiter
+from src.core.managers.online_manager import OnlineManager, SnapshotBuffer, Backoff, ONLINE, BACKOFF
+from src.core.managers.online_transport import LoopbackTransport
+
+FPS = 60
+WALK_SPEED = 4 * 64
+
+def _wait_for(condition, timeout: float) -> bool:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+def test_buffer_samples_received_together():
+    # A poll answered right before a sync: no velocity, and no ZeroDivisionError
+    buf = SnapshotBuffer("map.tmx")
+    buf.push(1.0, 0.0, 0.0)
+    buf.push(1.0, 5.0, 0.0)
+    assert buf.position(1.05, 0.25) == (5.0, 0.0)
+
+def test_buffer_interpolates_and_extrapolates():
+    buf = SnapshotBuffer("map.tmx")
+    buf.push(1.0, 0.0, 0.0)
+    buf.push(2.0, 10.0, 0.0)
+    assert buf.position(1.5, 0.25) == (5.0, 0.0)
+    assert buf.position(2.1, 0.25) == (11.0, 0.0)
+    # Not past the extrapolation limit
+    assert buf.position(3.0, 0.25) == (10.0, 0.0)
+
+def test_buffer_does_not_extrapolate_a_stopped_player():
+    buf = SnapshotBuffer("map.tmx")
+    buf.push(1.0, 0.0, 0.0)
+    buf.push(2.0, 10.0, 0.0)
+    buf.push(3.0, 10.0, 0.0)
+    assert buf.position(3.1, 0.25) == (10.0, 0.0)
+    # Received again: only its time is refreshed, it still stands there
+    buf.push(4.0, 10.0, 0.0)
+    assert buf.position(4.1, 0.25) == (10.0, 0.0)
+    assert buf.position(3.5, 0.25) == (10.0, 0.0)
+
+def test_backoff_grows_with_jitter_and_resets():
+    backoff = Backoff(base=0.5, maximum=2.0)
+    delays = [backoff.failed() for _ in range(5)]
+    for delay, full in zip(delays, (0.5, 1.0, 2.0, 2.0, 2.0)):
+        assert full / 2 <= delay <= full
+    backoff.succeeded()
+    assert backoff.failed() <= 0.5
+
+def test_remote_player_stops_where_it_stopped():
+    # Two clients over one in-process server: the one watching never draws the walker past where it stopped
+    handler = PlayerHandler()
+    handler.start()
+    limiter = UpdateLimiter()
+    walker = OnlineManager(LoopbackTransport(handler, latency=0.01, limiter=limiter))
+    watcher = OnlineManager(LoopbackTransport(handler, latency=0.01, limiter=limiter))
+    walker.enter()
+    watcher.enter()
+    try:
+        assert _wait_for(lambda: walker.player_id != -1 and watcher.player_id != -1, 2.0)
+        x = 100.0
+        drawn: list[float] = []
+        for frame in range(int(2.5 * FPS)):
+            if frame < FPS:
+                x += WALK_SPEED / FPS
+            walker.update(x, 200.0, "map.tmx")
+            watcher.update(500.0, 900.0, "map.tmx")
+            drawn += [p["x"] for p in watcher.get_render_players() if p["id"] == walker.player_id]
+            time.sleep(1 / FPS)
+        assert drawn
+        assert max(drawn) <= x + 1.0
+        assert abs(drawn[-1] - x) <= 1.0
+    finally:
+        walker.exit()
+        watcher.exit()
+        handler.stop()
+
+def test_backs_off_while_unreachable_then_registers():
+    handler = PlayerHandler()
+    handler.start()
+    transport = LoopbackTransport(handler, loss=1.0, seed=1)
+    manager = OnlineManager(transport)
+    manager.enter()
+    try:
+        assert _wait_for(lambda: manager.state == BACKOFF, 1.0)
+        assert manager.player_id == -1
+        transport.loss = 0.0
+        # The first retries come within BACKOFF_BASE, then twice that
+        assert _wait_for(lambda: manager.state == ONLINE and manager.player_id != -1, 3.0)
+        assert handler.locate(manager.player_id) is not None
+    finally:
+        manager.exit()
+        handler.stop()
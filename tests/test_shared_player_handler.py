@@ -0,0 +1,36 @@
+import multiprocessing
+import time
+
+from server.sharedPlayerHandler import SharedTable, SharedPlayerHandler, X, Y
+
+def test_readers_never_see_a_half_written_slot():
+    # Another process keeps writing x == y, readers copy the table without locking it
+    ctx = multiprocessing.get_context("fork")
+    handler = SharedPlayerHandler(SharedTable(ctx, 64), max_speed=None)
+    pids = [handler.register() for _ in range(8)]
+
+    def write(duration: float) -> None:
+        i = 0
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            i += 1
+            for pid in pids:
+                handler.update(pid, float(i), float(i), "map.tmx")
+
+    writer = ctx.Process(target=write, args=(1.0,))
+    writer.start()
+    torn = reads = 0
+    try:
+        while writer.is_alive():
+            _, rows = handler.table.read_all()
+            for row in rows:
+                reads += 1
+                torn += row[X] != row[Y]
+            for slot in range(len(pids)):
+                row = handler.table.read_slot(slot)
+                reads += 1
+                torn += row[X] != row[Y]
+    finally:
+        writer.join()
+    assert reads > 0
+    assert torn == 0